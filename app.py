@@ -4,7 +4,6 @@ from flask import (
     request,
     jsonify,
     Response,
-    current_app,
     send_from_directory,
 )
 from flask_httpauth import HTTPBasicAuth
@@ -18,13 +17,35 @@ import time
 from werkzeug.security import check_password_hash
 import threading
 import queue
+import collections
+import contextlib
+import heapq
+import itertools
 import datetime
+import errno
 import logging
+import logging.handlers
+import atexit
+import sys
 import hashlib
+import hmac
+import gzip
+import functools
+import sqlite3
+import uuid
+import urllib.error
+import urllib.parse
+import mutagen
 from mutagen.mp3 import MP3
 from mutagen.mp4 import MP4
+from mutagen.oggopus import OggOpus
 from mutagen.id3 import ID3, TIT2, TALB, TPE1, TPE2
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 app = Flask(__name__)
 auth = HTTPBasicAuth()
 
@@ -42,27 +63,121 @@ DEFAULT_OUTPUT_DIR = os.path.join(os.getcwd(), "final_output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(DEFAULT_OUTPUT_DIR, exist_ok=True)
 CACHE_DIR = os.path.join(os.getcwd(), "cache")
+# Size limit of the cache folder, the least recently used infos are removed first
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+# Seconds after which the cached video details are retrieved again
+CACHE_TTL = 30 * 24 * 3600
 FOLDERS_FILE = os.path.join(datafolder, "folders.json")
 COOKIES = os.path.join(datafolder, "cookies.txt")
+JOBS_DB = os.path.join(datafolder, "jobs.db")
+LIBRARY_DB = os.path.join(datafolder, "library.db")
+# Profiles of the jobs that were started with profiling enabled
+PROFILES_DIR = os.path.join(datafolder, "profiles")
+# Seconds between two stack samples of a profiled job
+PROFILE_INTERVAL = 0.01
+# Seconds a successful login is remembered before the password hash is checked again
+AUTH_CACHE_TTL = 300
+# Selectable output formats (the key is also the file extension): the yt-dlp
+# format selection and the audio codec extracted from it. Audio formats prefer
+# a source in the same codec, which is remuxed without re-encoding.
+# `rate` is the assumed bytes per second of a video, if its size is not known.
+OUTPUT_FORMATS = {
+    "mp3": {
+        "format": "bestaudio[acodec=mp3]/bestaudio/best",
+        "codec": "mp3",
+        "rate": 24_000,
+    },
+    "m4a": {
+        "format": "bestaudio[acodec^=mp4a]/bestaudio/best",
+        "codec": "m4a",
+        "rate": 24_000,
+    },
+    "opus": {
+        "format": "bestaudio[acodec=opus]/bestaudio/best",
+        "codec": "opus",
+        "rate": 24_000,
+    },
+    "mp4": {
+        "format": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
+        "codec": None,
+        "rate": 500_000,
+    },
+}
+# File extensions that are indexed in the library
+LIBRARY_FORMATS = tuple(OUTPUT_FORMATS)
 LOGS_DIR = "logs"
-# The user and group the files should be assigned to for file/folder permissions
+# The user and group the downloaded files/folders are assigned to (None keeps the owner)
 PERM_USER = "carn1v0re"
 PERM_GROUP = "bunk3rGroup"
+# ioctl request that clones a file without copying its data (reflink, Btrfs/XFS)
+FICLONE = 0x40049409
+# Permissions of the downloaded files and of the folders created for them
+PERM_FILE_MODE = 0o664
+PERM_DIR_MODE = 0o775
+# Folder the app creates in every staging folder, only its content is cleared on startup
+STAGING_SUBDIR = ".yt_dlp-webgui"
+# RAM disk (tmpfs) for downloading and converting, e.g. "/dev/shm/yt_dlp-webgui".
+# None downloads into the staging folders.
+SCRATCH_TMPFS = None
+# Bytes all running downloads may use on the RAM disk, larger ones are downloaded on disk
+SCRATCH_TMPFS_QUOTA = 2 * 1024 * 1024 * 1024
+# Number of URLs that are processed at the same time (across all users)
+DOWNLOAD_WORKERS = 3
+# Entries of one user that are downloaded at the same time
+USER_MAX_ENTRIES = 2
+# Share of the download workers and bandwidth per user (name in users.json), others get 1
+USER_WEIGHTS = {}
+# Seconds a URL keeps its download worker while other users wait, the rest continues later
+USER_TIME_SLICE = 120
+# Bytes per second of all downloads together, shared by the users by their weight. None = unlimited
+BANDWIDTH_LIMIT = None
+# Number of downloaded entries that are converted at the same time (ffmpeg processes)
+TRANSCODE_WORKERS = os.cpu_count() or 2
+# Downloaded entries that may wait for the next stage before downloading pauses
+PIPELINE_QUEUE_SIZE = 4
+# Number of finished jobs that are kept for the job overview
+JOB_HISTORY = 50
+# Syncs that retry a playlist video whose retrieval failed, afterwards it is skipped
+SYNC_RETRIES = 3
+# Titles of playlist videos that stay unavailable, sync records them without retrieving
+UNAVAILABLE_TITLES = ("[Private video]", "[Deleted video]")
+# Cleaned file names that are remembered, repeated titles are only cleaned once
+CLEAN_FILENAME_CACHE = 8192
+# Titles listed in the plan message of a URL, all entries are served by /jobs/<id>/plan
+PLAN_PREVIEW = 10
+# Entries per page of /jobs/<id>/plan
+PLAN_PAGE_SIZE = 100
+# Extracted stream URLs are only reused if they are valid for at least this many seconds
+STREAM_URL_MARGIN = 600
+# Assumed lifetime of stream URLs that do not state their expiry
+STREAM_URL_TTL = 5 * 3600
+
+# Number of progress messages that are kept per job for reconnecting clients
+PROGRESS_BUFFER = 500
+# Seconds between two batches of messages sent to a progress client
+PROGRESS_PACING = 0.25
+# Minimum seconds between two download progress events of a job
+PROGRESS_INTERVAL = 0.25
+# Seconds between two "still working" messages of a job
+HEARTBEAT_INTERVAL = 10
+# Seconds without download progress before a download is reported as stalled
+STALL_TIMEOUT = 60
+# Seconds without download progress before a download is ended, only its video fails
+STALL_ABORT = 5 * STALL_TIMEOUT
+
+# Requests per second to YouTube of all jobs together: start, lower and upper limit.
+# The rate is halved on a HTTP 429 and raised by RATE_LIMIT_STEP with every successful request.
+RATE_LIMIT_START = 2.0
+RATE_LIMIT_MIN = 0.1
+RATE_LIMIT_MAX = 10.0
+RATE_LIMIT_STEP = 0.01
+# Requests that may be sent right away after an idle time
+RATE_LIMIT_BURST = 5
+# Seconds all requests are paused after a HTTP 429
+RATE_LIMIT_PAUSE = 60
 
 # Globals
-current_download = None
-progress_queue = queue.Queue()
-cancel_flag = False
-is_converting = False
-last_percentage = None
 folder_paths = {}
-to_download = 0
-done_download = 1
-conv_heart = None
-complete_msg = ""
-moved_files = []
-missing_files = []
-unavailable_videos = []
 
 # --- Logging Setup ---
 os.makedirs(LOGS_DIR, exist_ok=True)
@@ -72,31 +187,336 @@ hasher.update(str(datetime.datetime.now()).encode("utf-8"))
 hash_str = hasher.hexdigest()[:6]
 log_filename = os.path.join(LOGS_DIR, f"{timestamp}--{hash_str}.log")
 
-logging.basicConfig(
-    filename=log_filename,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+class PlainFormatter(logging.Formatter):
+    """Removes the HTML used for the progress box from log lines."""
+
+    def formatMessage(self, record):
+        return (
+            super()
+            .formatMessage(record)
+            .replace("<br>", "\n")
+            .replace("<strong>", "")
+            .replace("</strong>", "")
+        )
+
+
+# The callers only put records on a queue, the console and file are written
+# by the listener thread, so logging never blocks a download.
+file_handler = logging.FileHandler(log_filename, encoding="utf-8")
+file_handler.setFormatter(PlainFormatter("%(asctime)s - %(levelname)s - %(message)s"))
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setFormatter(PlainFormatter("%(message)s"))
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue, file_handler, console_handler, respect_handler_level=True
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+
+# --- Progress Broadcaster ---
+class ProgressBroadcaster:
+    """
+    Fans out progress messages to any number of clients.
+    Every job keeps a bounded ring buffer of its messages, every client
+    only holds the ID of the last message it has seen. Slow or stalled
+    clients therefore cost no memory, they just skip what was dropped.
+    State messages (like the download progress) only keep their latest value.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffers = {}
+        self.states = {}
+        self.last_id = 0
+        self.cond = threading.Condition()
+
+    def publish(self, message, job_id=None, event="message"):
+        with self.cond:
+            self.last_id += 1
+            buffer = self.buffers.get(job_id)
+            if buffer is None:
+                buffer = self.buffers[job_id] = collections.deque(maxlen=self.size)
+            buffer.append((self.last_id, job_id, event, message))
+            self.cond.notify_all()
+
+    def publish_state(self, message, job_id, event):
+        """Publishes a message that replaces the previous `event` message of the job."""
+        with self.cond:
+            self.last_id += 1
+            self.states[(job_id, event)] = (self.last_id, job_id, event, message)
+            self.cond.notify_all()
+
+    def drop(self, job_id):
+        with self.cond:
+            self.buffers.pop(job_id, None)
+            for key in [key for key in self.states if key[0] == job_id]:
+                del self.states[key]
+
+    def read(self, after, visible, timeout):
+        """
+        Returns the messages with an ID greater than `after`, waiting up to
+        `timeout` seconds for new ones. `visible(job_id)` selects the jobs,
+        messages of other jobs do not end the wait.
+        Returns the ID to continue after with the messages.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                events = [
+                    event
+                    for job_id, buffer in self.buffers.items()
+                    if visible(job_id) and buffer and buffer[-1][0] > after
+                    for event in buffer
+                    if event[0] > after
+                ]
+                events.extend(
+                    state
+                    for (job_id, _), state in self.states.items()
+                    if state[0] > after and visible(job_id)
+                )
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    break
+                # Everything up to here is invisible for this client
+                after = self.last_id
+                self.cond.wait(remaining)
+            after = self.last_id
+        events.sort(key=lambda event: event[0])
+        return after, events
+
+
+broadcaster = ProgressBroadcaster(PROGRESS_BUFFER)
+
+
+# --- Scheduler ---
+class Timer:
+    """Handle of a scheduled call, see Scheduler."""
+
+    def __init__(self, interval, func, args):
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Runs the timers of all jobs (heartbeats, stall detection) on a single
+    thread. Timers are kept in a heap ordered by their due time, cancelled
+    timers are dropped when they come up.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def call_every(self, interval, func, *args):
+        return self._add(time.monotonic() + interval, Timer(interval, func, args))
+
+    def _add(self, due, timer):
+        with self.cond:
+            if not self.thread:
+                self.thread = threading.Thread(
+                    target=self._run, name="scheduler", daemon=True
+                )
+                self.thread.start()
+            heapq.heappush(self.heap, (due, next(self.counter), timer))
+            self.cond.notify()
+        return timer
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    self.cond.wait(timeout)
+                due, _, timer = heapq.heappop(self.heap)
+                if timer.cancelled:
+                    continue
+                if timer.interval:
+                    heapq.heappush(
+                        self.heap, (due + timer.interval, next(self.counter), timer)
+                    )
+            try:
+                timer.func(*timer.args)
+            except Exception as e:
+                logging.exception(f"Timer {timer.func} failed: {e}")
+
+
+scheduler = Scheduler()
+
+
+# --- Metrics ---
+class Metric:
+    """
+    A counter, gauge or histogram with labels, rendered in the Prometheus text
+    format. Gauges can be given a function that is read when they are scraped.
+    """
+
+    def __init__(self, kind, name, help, buckets=None, func=None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.func = func
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * len(self.buckets) + [0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def _labels(key, **extra):
+        pairs = [*key, *extra.items()]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.func:
+            for labels, value in self.func().items():
+                lines.append(f"{self.name}{self._labels(tuple(labels))} {value}")
+            return lines
+        with self.lock:
+            values = dict(self.values)
+        for key, value in values.items():
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{self._labels(key)} {value}")
+                continue
+            for bound, count in zip(self.buckets, value):
+                lines.append(f"{self.name}_bucket{self._labels(key, le=bound)} {count}")
+            lines.append(f"{self.name}_bucket{self._labels(key, le='+Inf')} {value[-2]}")
+            lines.append(f"{self.name}_count{self._labels(key)} {value[-2]}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {value[-1]}")
+        return lines
+
+
+class Metrics:
+    """All metrics of the app, served at /metrics."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, kind, name, help, **kwargs):
+        metric = Metric(kind, name, help, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+
+# Buckets in seconds and bytes per second
+TIME_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SPEED_BUCKETS = tuple(2**i * 1024 for i in range(6, 16))
+
+metrics = Metrics()
+extraction_seconds = metrics.add(
+    "histogram", "ytdl_extraction_seconds", "Time to retrieve the info of a URL", buckets=TIME_BUCKETS
+)
+downloaded_bytes = metrics.add(
+    "counter", "ytdl_downloaded_bytes_total", "Bytes downloaded from YouTube"
+)
+download_speed = metrics.add(
+    "histogram", "ytdl_download_speed_bytes", "Average speed of a downloaded file", buckets=SPEED_BUCKETS
+)
+transcode_seconds = metrics.add(
+    "histogram", "ytdl_transcode_seconds", "Time to convert a downloaded file", buckets=TIME_BUCKETS
+)
+finalize_seconds = metrics.add(
+    "histogram", "ytdl_finalize_seconds", "Time of the move, tag and chown steps", buckets=TIME_BUCKETS
+)
+cache_requests = metrics.add(
+    "counter", "ytdl_cache_requests_total", "Lookups in the info cache by result"
+)
+retries = metrics.add("counter", "ytdl_retries_total", "Retries of yt-dlp by cause")
+rate_limit_pauses = metrics.add(
+    "counter", "ytdl_rate_limit_pauses_total", "Pauses of all requests after a HTTP 429"
+)
+request_rate = metrics.add(
+    "gauge",
+    "ytdl_request_rate",
+    "Requests per second the rate limiter currently allows",
+    func=lambda: {(): rate_limiter.rate},
+)
+queue_depth = metrics.add(
+    "gauge",
+    "ytdl_queue_depth",
+    "Items waiting in the queues of the job engine",
+    func=lambda: {
+        (("queue", "urls"),): engine.tasks.qsize(),
+        (("queue", "transcode"),): transcode_stage.items.qsize(),
+        (("queue", "finalize"),): finalize_stage.items.qsize(),
+    },
+)
+active_workers = metrics.add(
+    "gauge",
+    "ytdl_active_workers",
+    "Workers that are currently busy",
+    func=lambda: {
+        (("pool", "download"),): engine.busy,
+        (("pool", "transcode"),): transcode_stage.busy,
+        (("pool", "finalize"),): finalize_stage.busy,
+    },
 )
 
 
 # --- Helper Functions ---
-def log_message(message, box=True, framed=False):
-    """Logs a message to the console, the log file, and the progress queue."""
-    message = re.sub(r"\x1b\[[0-9;]*m", "", message)
+# The job the current thread works for, see working_for
+current_job = threading.local()
+
+
+@contextlib.contextmanager
+def working_for(job):
+    """Messages logged without a job in this block (retries, rate limits, ...) belong to `job`."""
+    previous = getattr(current_job, "id", None)
+    current_job.id = job.id
+    try:
+        yield
+    finally:
+        current_job.id = previous
+
+
+def log_message(message, box=True, framed=False, job_id=None):
+    """Logs a message to the console, the log file, and the progress broadcaster."""
+    message = ANSI_ESCAPE.sub("", message)
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     full_message = f"[{timestamp}] {message}"
     if framed:
         full_message = (20 * "-") + "<br>" + full_message + "<br>" + (20 * "-")
     if box:
-        progress_queue.put(full_message)
-    full_message = (
-        full_message.replace("<br>", "\n")
-        .replace("<strong>", "")
-        .replace("</strong>", "")
-    )
-    print(full_message)
+        broadcaster.publish(full_message, job_id or getattr(current_job, "id", None))
     logging.info(full_message)
-    time.sleep(0.25)
 
 
 def load_users():
@@ -119,99 +539,272 @@ def load_folders():
         }
 
 
+def load_staging():
+    """
+    Working folders per output folder from the optional "staging" section of
+    data/folders.json. A staging folder on the same filesystem as the output
+    folder turns the final move into a rename. Defaults to OUTPUT_DIR.
+    The app works in its own STAGING_SUBDIR, so a staging folder that holds
+    other files (or even the output folder itself) is never cleared.
+    """
+    if os.path.exists(FOLDERS_FILE):
+        with open(FOLDERS_FILE, "r") as f:
+            staging = json.load(f).get("staging", {})
+        return {name: os.path.join(path, STAGING_SUBDIR) for name, path in staging.items()}
+    return {}
+
+
 users = load_users()
+users_stamp = None
 folder_paths = load_folders()
+staging_paths = load_staging()
+
+
+YOUTUBE_HOSTS = {"youtube.com", "youtube-nocookie.com", "youtu.be"}
+YOUTUBE_VIDEO_ID = re.compile(r"^[0-9A-Za-z_-]{11}$")
+YOUTUBE_PLAYLIST_ID = re.compile(r"^[0-9A-Za-z_-]{10,}$")
+# Other YouTube pages (channels, @handles, ...) that are passed to yt-dlp as they are
+YOUTUBE_URL = re.compile(
+    r"(https?://)?(www\.)?"
+    r"(youtube|youtu|youtube-nocookie)\.(com|be)/"
+    r"(playlist\?list=|watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11,})"
+)
+
+
+def youtube_key(url):
+    """
+    Returns the ("video", id) or ("playlist", id) of a YouTube URL, or None.
+    Variants like youtu.be/X, watch?v=X&t=10 or watch?v=X&list=... all
+    result in the same ("video", "X"). Other YouTube pages are ("url", url).
+    """
+    parsed = urllib.parse.urlparse(url.strip() if "://" in url else "https://" + url.strip())
+    host = (parsed.hostname or "").lower()
+    for prefix in ("www.", "m.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix) :]
+    if host not in YOUTUBE_HOSTS:
+        return None
+    query = urllib.parse.parse_qs(parsed.query)
+    parts = [part for part in parsed.path.split("/") if part]
+
+    if host == "youtu.be":
+        video_id = parts[0] if parts else None
+        if video_id == "playlist" and query.get("list"):
+            return ("playlist", query["list"][0])
+    elif parts == ["playlist"]:
+        playlist_id = (query.get("list") or [None])[0]
+        if playlist_id and YOUTUBE_PLAYLIST_ID.match(playlist_id):
+            return ("playlist", playlist_id)
+        video_id = None
+    elif query.get("v"):
+        video_id = query["v"][0]
+    elif len(parts) >= 2 and parts[0] in ("embed", "v", "shorts", "live"):
+        video_id = parts[1]
+    else:
+        video_id = None
+
+    if video_id and YOUTUBE_VIDEO_ID.match(video_id):
+        return ("video", video_id)
+    if YOUTUBE_URL.match(url.strip()):
+        return ("url", parsed._replace(scheme="https", netloc=parsed.netloc.lower()).geturl())
+    return None
+
+
+def canonical_url(url):
+    """Returns the canonical URL of a YouTube video or playlist URL."""
+    kind, key = youtube_key(url)
+    if kind == "url":
+        return key
+    if kind == "playlist":
+        return f"https://www.youtube.com/playlist?list={key}"
+    return f"https://www.youtube.com/watch?v={key}"
 
 
 def is_playlist(url):
-    return "playlist?list=" in url or "youtu.be/playlist?" in url
+    key = youtube_key(url)
+    return bool(key) and key[0] == "playlist"
 
 
 def is_valid_youtube_url(url):
-    youtube_regex = (
-        r"(https?://)?(www\.)?"
-        "(youtube|youtu|youtube-nocookie)\.(com|be)/"
-        "(playlist\?list=|watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11,})"
-    )
-    youtube_regex_match = re.match(youtube_regex, url)
-    return bool(youtube_regex_match)
+    return youtube_key(url) is not None
+
+
+class SharedCalls:
+    """Lets concurrent callers with the same key share a single call."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def run(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            owner = call is None
+            if owner:
+                call = self.calls[key] = {"done": threading.Event()}
+        if not owner:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = func()
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
 
 
-def my_hook(d):
-    global last_percentage, is_converting, to_download, done_download, conv_heart
+# Info retrievals that are currently running, by canonical URL
+inflight_extractions = SharedCalls()
+
+
+class DownloadStalled(yt_dlp.utils.DownloadCancelled):
+    """Ends a download without progress for STALL_ABORT seconds, yt-dlp passes it on like a cancel."""
+
+
+def my_hook(d, job=None):
     if d["status"] == "info":
-        log_message(d["msg"])
+        job.log(d["msg"])
     elif d["status"] == "downloading":
-        is_converting = False
-        if conv_heart:
-            conv_heart.join()
-        percent_str = re.sub(r"\x1b\[[0-9;]*m", "", d["_percent_str"])
-        rate_str = re.sub(r"\x1b\[[0-9;]*m", "", d.get("_speed_str", "N/A"))
-        total_bytes_str = d.get("_total_bytes_str", "N/A")
-
-        progress_message = f"Download [{done_download:>2}/{to_download:<2}] | {percent_str:<6} of {total_bytes_str:<6} | {rate_str:<6}"
-
-        if percent_str != last_percentage:
-            last_percentage = percent_str
-            log_message(progress_message)
+        if job.cancelled:
+            raise yt_dlp.utils.DownloadCancelled("Download canceled (by User)")
+        job.set_stage("download")
+        job.report_progress(d)
+        job.check_stalled()
     elif d["status"] == "finished":
-        is_converting = True
-        done_download += 1
-        log_message(
-            "Download of media finished. Start Converting...<br>⚠️ This could take a while, depending on size...",
+        job.set_stage("convert")
+        job.report_progress(d, "convert", force=True)
+        size = d.get("total_bytes") or d.get("downloaded_bytes") or 0
+        downloaded_bytes.inc(size)
+        if d.get("elapsed"):
+            download_speed.observe(size / d["elapsed"])
+        with job.lock:
+            job.done_download += 1
+        job.log(
+            "Download of media finished. Queued for converting...<br>⚠️ This could take a while, depending on size...",
             True,
             True,
         )
-        conv_heart = threading.Thread(target=send_conv_heartbeat, daemon=True)
-        conv_heart.start()
     elif d["status"] == "failed":
-        log_message(f"Error: {d['msg']}")
+        job.log(f"Error: {d['msg']}")
     elif d["status"] == "test":
-        log_message(d["msg"])
+        job.log(d["msg"])
     elif d["status"] == "moving":
-        log_message(d["msg"])
+        job.log(d["msg"])
     elif d["status"] == "complete":
-        log_message(d["msg"], True, True)
+        job.log(d["msg"], True, True)
 
 
-def send_conv_heartbeat():
-    """Sends periodic heartbeat messages while conversion is ongoing."""
-    global is_converting
-    start_time = time.time()
-    while is_converting:
-        elapsed = int(time.time() - start_time)
-        if elapsed <= 5:
-            continue
-        log_message(f"⏳ Still working... {elapsed}s elapsed", True)
-        time.sleep(10)
-    return
+def set_owner(paths, user=PERM_USER, group=PERM_GROUP):
+    """
+    Sets owner and mode of the given files and folders, not of their content.
+    Only the paths a download created are passed, existing files stay untouched.
+    """
+    failed = []
+    for path in paths:
+        try:
+            if user or group:
+                shutil.chown(path, user, group)
+            os.chmod(path, PERM_DIR_MODE if os.path.isdir(path) else PERM_FILE_MODE)
+        except Exception as e:
+            failed.append(f"{path}: {e}")
+    if failed:
+        log_message(
+            f"Error while setting permissions of {len(failed)} paths, first: {failed[0]}"
+        )
 
 
-def set_owner_recursive(path, user, group):
-    try:
-        for root, dirs, files in os.walk(path):
-            for d in dirs:
-                shutil.chown(os.path.join(root, d), user, group)
-                os.chmod(os.path.join(root, d), 0o775)
-            for f in files:
-                shutil.chown(os.path.join(root, f), user, group)
-                os.chmod(os.path.join(root, f), 0o664)
-        shutil.chown(path, user, group)
-        os.chmod(path, 0o775)
-    except Exception as e:
-        log_message(f"Error while setting permissions: {e}")
+def clear_stale_output(folder, keep_jobs):
+    """Clears the working folders of all users, except the ones of `keep_jobs`."""
+    for username in os.listdir(folder):
+        user_path = os.path.join(folder, username)
+        if not os.path.isdir(user_path):
+            continue
+        for name in os.listdir(user_path):
+            if name.split("-")[0] in keep_jobs:
+                continue
+            file_path = os.path.join(user_path, name)
+            try:
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.unlink(file_path)
+            except Exception as e:
+                log_message(f"Delete of '{file_path}' failed. Reason: {e}")
 
 
-def clear_output_folder(folder):
-    for filename in os.listdir(folder):
-        file_path = os.path.join(folder, filename)
+def copy_file(src, dst):
+    """
+    Copies a file inside the kernel: as reflink if the filesystem supports it,
+    else with copy_file_range or sendfile. Falls back to a normal copy.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if fcntl:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+        size = os.fstat(fsrc.fileno()).st_size
+        for method in ("copy_file_range", "sendfile"):
+            if not hasattr(os, method):
+                continue
+            fdst.seek(0)
+            fdst.truncate()
+            offset = 0
+            try:
+                while offset < size:
+                    if method == "sendfile":
+                        copied = os.sendfile(
+                            fdst.fileno(), fsrc.fileno(), offset, size - offset
+                        )
+                    else:
+                        copied = os.copy_file_range(
+                            fsrc.fileno(), fdst.fileno(), size - offset, offset, offset
+                        )
+                    if not copied:
+                        break
+                    offset += copied
+            except OSError:
+                continue
+            if offset == size:
+                return
+        fdst.seek(0)
+        fdst.truncate()
+        fsrc.seek(0)
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def move_file(src, dst):
+    """
+    Moves a file into the library. This is a rename if both are on the same
+    filesystem, else the file is copied next to `dst` and renamed afterwards,
+    so the library never contains a half copied file.
+    """
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temp_path = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.part")
+    try:
+        copy_file(src, temp_path)
         try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-        except Exception as e:
-            log_message(f"Delete of '{file_path}' failed. Reason: {e}")
+            shutil.copystat(src, temp_path)
+        except OSError:
+            pass  # e.g. network shares that do not allow setting the times
+        os.replace(temp_path, dst)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    os.unlink(src)
 
 
 def load_translations(language=DEFAULT_LANG):
@@ -219,14 +812,33 @@ def load_translations(language=DEFAULT_LANG):
         return json.load(f)
 
 
+class FilenameTable(dict):
+    """
+    Translation table for clean_filename that decides once per character
+    whether it is kept: non-printable characters, symbols and the
+    characters that are not allowed in file names are removed.
+    """
+
+    def __missing__(self, code):
+        c = chr(code)
+        keep = (
+            c.isprintable()
+            and not unicodedata.category(c).startswith("So")
+            and c not in '<>:"/\\|?*⧸©'
+        )
+        self[code] = code if keep else None
+        return self[code]
+
+
+filename_table = FilenameTable()
+
+
+@functools.lru_cache(maxsize=CLEAN_FILENAME_CACHE)
 def clean_filename(filename: str) -> str:
-    filename = unicodedata.normalize("NFKD", filename)
-    filename = "".join(
-        c
-        for c in filename
-        if c.isprintable() and not unicodedata.category(c).startswith("So")
-    )
-    filename = re.sub(r'[<>:"/\\|?*\x00-\x1F⧸©]', "", filename)
+    # NFKD does not change ASCII
+    if not filename.isascii():
+        filename = unicodedata.normalize("NFKD", filename)
+    filename = filename.translate(filename_table)
     filename = filename.replace("  ", " ")
     filename = filename.strip().strip(".")
     return filename
@@ -246,61 +858,407 @@ def fix_mp3(file_path):
         return False
 
 
-def update_metadata(username, file_path, album):
-    """Update metadata for MP3 and MP4 files."""
+def album_title(username, folder):
+    """The album and album artist of the files in `folder`."""
+    return f"{username.capitalize()} - {os.path.basename(folder)}"
+
+
+def update_metadata(username, file_path, album, retry=True):
+    """
+    Update album and album artist of MP3, M4A/MP4 and Opus files.
+    Files that already have these tags are not written, returns True if the file changed.
+    """
+    title = album_title(username, album)
     try:
-        album = f"{username.capitalize()} - {album}"
         if file_path.endswith(".mp3"):
             audio = MP3(file_path, ID3=ID3)
             if audio.tags is None:
                 audio.add_tags()
+            current = [str(audio.tags.get("TALB", "")), str(audio.tags.get("TPE2", ""))]
+            if current == [title, title]:
+                return False
 
-            audio.tags[TALB] = TALB(encoding=3, text=album)
-            audio.tags[TPE2] = TPE2(encoding=3, text=album)
+            audio.tags.setall("TALB", [TALB(encoding=3, text=title)])
+            audio.tags.setall("TPE2", [TPE2(encoding=3, text=title)])
 
             audio.save()
-        elif file_path.endswith(".mp4"):
+        elif file_path.endswith((".mp4", ".m4a")):
             audio = MP4(file_path)
-            audio.tags["\xa9alb"] = [album]
-            audio.tags["aART"] = [album]
+            if audio.tags is None:
+                audio.add_tags()
+            if audio.tags.get("\xa9alb") == [title] and audio.tags.get("aART") == [title]:
+                return False
+            audio.tags["\xa9alb"] = [title]
+            audio.tags["aART"] = [title]
             audio.save()
+        elif file_path.endswith(".opus"):
+            audio = OggOpus(file_path)
+            if audio.get("album") == [title] and audio.get("albumartist") == [title]:
+                return False
+            audio["album"] = [title]
+            audio["albumartist"] = [title]
+            audio.save()
+        else:
+            return False
         log_message(f"✅ Updated metadata for: {file_path}")
+        return True
     except Exception as e:
         log_message(f"❌ Error while updating metadata for {file_path}: {e}")
-        if file_path.endswith(".mp3") and fix_mp3(file_path):
-            update_metadata(username, file_path, album)
+        if retry and file_path.endswith(".mp3") and fix_mp3(file_path):
+            return update_metadata(username, file_path, album, False)
+        return False
+
+
+# Fields of the extracted info that are used for planning, downloading
+# and the metadata postprocessors. Everything else is not cached.
+CACHE_INFO_FIELDS = (
+    "_type", "id", "title", "fulltitle", "alt_title", "display_id", "ext",
+    "description", "uploader", "uploader_id", "uploader_url", "channel",
+    "channel_id", "channel_url", "creator", "artist", "track", "album",
+    "album_artist", "genre", "release_year", "release_date", "upload_date",
+    "timestamp", "duration", "duration_string", "thumbnail", "thumbnails",
+    "chapters", "availability", "live_status", "is_live", "was_live",
+    "age_limit", "webpage_url", "original_url", "webpage_url_basename",
+    "webpage_url_domain", "extractor", "extractor_key", "playlist",
+    "playlist_id", "playlist_title", "playlist_index", "playlist_count",
+    "n_entries", "epoch", "http_headers", "_format_sort_fields",
+)  # fmt: skip
+
+
+def compact_info(info):
+    """Reduces an extracted info to the fields the app uses, without storyboards."""
+    if not info:
+        return info
+    compact = {k: info[k] for k in CACHE_INFO_FIELDS if info.get(k) is not None}
+    if info.get("entries") is not None:
+        compact["entries"] = [compact_info(entry) for entry in info["entries"]]
+    if info.get("formats"):
+        compact["formats"] = [
+            f for f in info["formats"] if f.get("format_note") != "storyboard"
+        ]
+    return compact
+
+
+def drop_expired_formats(info):
+    """Removes expired stream URLs, those videos are extracted again on download."""
+    if not info:
+        return
+    for entry in info.get("entries") or []:
+        drop_expired_formats(entry)
+    if info.get("formats") and info_expired(info):
+        del info["formats"]
+
+
+class MetadataCache:
+    """
+    Gzipped cache of the retrieved video details in CACHE_DIR.
+    The video details are valid for CACHE_TTL, the stream URLs only until they
+    expire. The folder is kept below `max_bytes` by removing the least
+    recently used files.
+    """
+
+    def __init__(self, folder, max_bytes, ttl):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.files = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _index(self):
+        """Returns the cached files as {name: [size, last_used]}, scanned once."""
+        if self.files is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self.files = {}
+            for entry in os.scandir(self.folder):
+                if entry.is_file():
+                    stat = entry.stat()
+                    self.files[entry.name] = [stat.st_size, stat.st_mtime]
+        return self.files
+
+    def filename(self, url):
+        """Generate a hash-based filename for a given URL."""
+        return hashlib.md5(url.encode()).hexdigest()[:10] + ".json.gz"
+
+    def load(self, url):
+        name = self.filename(url)
+        path = os.path.join(self.folder, name)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        with self.lock:
+            files = self._index()
+            if not data or data["fetched"] + self.ttl < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            if name in files:
+                files[name][1] = time.time()
+        os.utime(path)
+        info = data["info"]
+        drop_expired_formats(info)
+        return info
+
+    def save(self, url, info):
+        name = self.filename(url)
+        path = os.path.join(self.folder, name)
+        data = json.dumps(
+            {"url": url, "fetched": time.time(), "info": compact_info(info)},
+            separators=(",", ":"),
+            default=str,
+        )
+        with self.lock:
+            self._index()
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.files[name] = [os.path.getsize(path), time.time()]
+            self._evict()
+
+    def _evict(self):
+        total = sum(size for size, _ in self.files.values())
+        for name, (size, _) in sorted(self.files.items(), key=lambda f: f[1][1]):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            del self.files[name]
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            files = self._index()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "files": len(files),
+                "bytes": sum(size for size, _ in files.values()),
+            }
 
 
-def get_cache_filename(url):
-    """Generate a hash-based filename for a given URL."""
-    hash_str = hashlib.md5(url.encode()).hexdigest()[:10]
-    return os.path.join(CACHE_DIR, f"{hash_str}.json")
+metadata_cache = MetadataCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL)
 
 
 def save_to_cache(url, info):
-    """Save the retrieved info to a JSON cache file."""
-    cache_file = get_cache_filename(url)
-    cache_hash = os.path.basename(cache_file).replace(".json", "")
-    log_message(f"💾 Cached Hash: {cache_hash}")
-    with open(cache_file, "w", encoding="utf-8") as f:
-        json.dump({"url": url, "info": info}, f, indent=4)
+    """Save the retrieved info to the cache."""
+    log_message(f"💾 Cached Hash: {metadata_cache.filename(url).split('.')[0]}")
+    metadata_cache.save(url, info)
 
 
 def load_from_cache(url):
-    """Load cached info if it exists."""
-    cache_file = get_cache_filename(url)
-    if os.path.exists(cache_file):
-        cache_hash = os.path.basename(cache_file).replace(".json", "")
-        log_message(f"💾 Cached Hash: {cache_hash}")
-        with open(cache_file, "r", encoding="utf-8") as f:
-            return json.load(f)["info"]
-    return None
+    """Load cached info if it exists and is not expired."""
+    info = metadata_cache.load(url)
+    cache_requests.inc(result="hit" if info else "miss")
+    stats = metadata_cache.stats()
+    if info:
+        log_message(
+            f"💾 Cached Hash: {metadata_cache.filename(url).split('.')[0]} "
+            f"(hits: {stats['hits']}, misses: {stats['misses']})"
+        )
+    return info
+
+
+def info_expired(info, margin=STREAM_URL_MARGIN):
+    """Checks if the signed stream URLs of an extracted video are (about to be) expired."""
+    expires = []
+    for f in info.get("formats") or []:
+        match = re.search(r"[?&/]expire[=/](\d+)", f.get("url") or "")
+        if match:
+            expires.append(int(match.group(1)))
+    if expires:
+        return min(expires) - margin < time.time()
+    epoch = info.get("epoch")
+    return not info.get("formats") or not epoch or epoch + STREAM_URL_TTL < time.time()
+
+
+def estimate_size(entry, format_type):
+    """
+    Rough size of an entry in the scratch folder: its selected formats, or its
+    duration at the assumed rate of the format. Doubled for the converted file.
+    """
+    formats = entry.get("requested_formats") or [entry]
+    size = sum(f.get("filesize") or f.get("filesize_approx") or 0 for f in formats)
+    if not size:
+        size = (entry.get("duration") or 600) * OUTPUT_FORMATS[format_type]["rate"]
+    return 2 * size
+
+
+def download_entry(ydl, entry, job):
+    """
+    Downloads a video from its already extracted info.
+    The video is only extracted again if its stream URLs have expired.
+    """
+    url = entry.get("webpage_url") or entry.get("original_url")
+    if info_expired(entry):
+        job.log(f"♻️ Stream URLs expired, retrieving again:<br>{url}")
+        return ydl.extract_info(url, download=True)
+    # With ignoreerrors yt-dlp only reports a failed download, it has to
+    # raise here to retrieve the video again
+    ignoreerrors = ydl.params.get("ignoreerrors")
+    ydl.params["ignoreerrors"] = False
+    info = ydl.sanitize_info(entry, remove_private_keys=True)
+    # Private, but the extractor's format order (e.g. YouTube ranks throttled
+    # formats lower), without it yt-dlp could pick another format
+    if "_format_sort_fields" in entry:
+        info["_format_sort_fields"] = entry["_format_sort_fields"]
+    try:
+        return ydl.process_ie_result(info, download=True)
+    except yt_dlp.utils.DownloadCancelled:
+        raise
+    except yt_dlp.utils.DownloadError as e:
+        error = e
+    finally:
+        ydl.params["ignoreerrors"] = ignoreerrors
+    job.log(f"⚠️ Download from cached info failed, retrieving again:<br>{error}")
+    return ydl.extract_info(url, download=True)
+
+
+class RateLimiter:
+    """
+    Paces the requests of all jobs to YouTube, for extraction and download.
+    A token bucket whose rate is raised a little with every successful
+    request and halved on a HTTP 429, which also pauses all requests (AIMD).
+    """
+
+    def __init__(
+        self,
+        rate=RATE_LIMIT_START,
+        min_rate=RATE_LIMIT_MIN,
+        max_rate=RATE_LIMIT_MAX,
+        burst=RATE_LIMIT_BURST,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until the next request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_LIMIT_STEP)
+
+    def backoff(self):
+        """
+        Halves the rate and pauses all requests after a HTTP 429. The 429s of
+        requests that were sent before the pause count as one.
+        Returns the seconds until requests are sent again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = now + RATE_LIMIT_PAUSE
+            rate = self.rate
+        rate_limit_pauses.inc()
+        log_message(
+            f"🚨 Rate limit hit (HTTP 429). Pausing all downloads for {RATE_LIMIT_PAUSE} seconds, "
+            f"then continuing with {rate:.2f} requests/s...",
+            True,
+            True,
+        )
+        return RATE_LIMIT_PAUSE
+
+
+rate_limiter = RateLimiter()
+
+
+class PacedYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL whose requests wait for the shared rate limiter."""
+
+    def urlopen(self, req):
+        rate_limiter.acquire()
+        try:
+            response = super().urlopen(req)
+        except urllib.error.HTTPError as e:
+            if e.code == 429:
+                rate_limiter.backoff()
+            raise
+        rate_limiter.success()
+        return response
+
+
+# yt-dlp only passes the attempt to the retry sleep functions. The error is
+# taken from the warning it logs right before, in the same thread.
+retry_errors = threading.local()
+
+# Parts of error messages that are caused by the network, not by YouTube
+NETWORK_ERRORS = (
+    "cannot assign requested address",
+    "timed out",
+    "connection reset",
+    "connection refused",
+    "name resolution",
+    "network is unreachable",
+)
+
+
+class YtdlpLogger:
+    """
+    Prints the output of yt-dlp like it does without a logger and remembers
+    its retry warnings for my_retry_sleep.
+    """
+
+    def debug(self, msg):
+        # Normal output is passed as debug message as well, without the prefix.
+        # The retries of downloads are reported this way ("[download] Got error: ...").
+        if not msg.startswith("[debug] "):
+            self.remember_retry(msg)
+            print(msg)
+
+    def info(self, msg):
+        print(msg)
+
+    def warning(self, msg):
+        self.remember_retry(msg)
+        print(f"WARNING: {msg}", file=sys.stderr)
+
+    def remember_retry(self, msg):
+        if "Retrying" in msg:
+            retry_errors.last = msg
+
+    def error(self, msg):
+        print(msg, file=sys.stderr)
 
 
 def my_retry_sleep(last_error=None, n=None):
     """
     Returns the sleep time before retrying and logs the reason.
     """
+    if last_error is None:
+        last_error = getattr(retry_errors, "last", None)
+        retry_errors.last = None
+    # A download that only retries does not make progress either
+    job = engine.get_job(getattr(current_job, "id", None))
+    if job:
+        job.check_stalled()
     retry_count = n
     base_sleep = min(10 * (2 ** (retry_count - 1)), 60)
     sleep_time = base_sleep
@@ -308,8 +1266,9 @@ def my_retry_sleep(last_error=None, n=None):
     if last_error:
         error_message = str(last_error).lower()
 
-        if "cannot assign requested address" in error_message:
+        if any(error in error_message for error in NETWORK_ERRORS):
             sleep_time = 30
+            retries.inc(cause="network")
             log_message(
                 f"⚠️ Network issue detected. Retrying in {sleep_time} seconds...",
                 True,
@@ -317,15 +1276,13 @@ def my_retry_sleep(last_error=None, n=None):
             )
 
         elif "429" in error_message or "too many requests" in error_message:
-            sleep_time = 60
-            log_message(
-                f"🚨 Rate limit hit (HTTP 429). Retrying in {sleep_time} seconds...",
-                True,
-                True,
-            )
+            # All jobs wait for the rate limiter, the retry only has to wait for the pause
+            sleep_time = rate_limiter.backoff()
+            retries.inc(cause="429")
 
         elif "http error 403" in error_message:
             sleep_time = 5
+            retries.inc(cause="403")
             log_message(
                 f"🔒 HTTP 403 Forbidden. Retrying in {sleep_time} seconds...",
                 True,
@@ -333,6 +1290,7 @@ def my_retry_sleep(last_error=None, n=None):
             )
 
         else:
+            retries.inc(cause="other")
             log_message(
                 f"⚠️ Unknown error: {last_error}. Retrying in {sleep_time} seconds...",
                 True,
@@ -340,15 +1298,1183 @@ def my_retry_sleep(last_error=None, n=None):
             )
 
     else:
+        retries.inc(cause="unknown")
         log_message(f"🔄 Retrying in {sleep_time} seconds...", True, True)
 
     return sleep_time
 
 
+# --- Job Store ---
+class JobStore:
+    """Persists jobs, their URLs and the state of every entry in SQLite."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    options TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    finished REAL
+                );
+                CREATE TABLE IF NOT EXISTS urls (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    url TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    PRIMARY KEY (job_id, idx)
+                );
+                CREATE TABLE IF NOT EXISTS manifests (
+                    playlist_id TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    format_type TEXT NOT NULL,
+                    video_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (playlist_id, target, format_type, video_id)
+                );
+                CREATE TABLE IF NOT EXISTS entries (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    video_id TEXT NOT NULL,
+                    title TEXT,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    updated REAL NOT NULL,
+                    url TEXT,
+                    target TEXT,
+                    PRIMARY KEY (job_id, idx, video_id)
+                );
+                CREATE TABLE IF NOT EXISTS spans (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER,
+                    video_id TEXT,
+                    name TEXT NOT NULL,
+                    start REAL NOT NULL,
+                    end REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS spans_job ON spans (job_id);
+                """
+            )
+            # Databases of older versions lack the plan columns of the entries
+            columns = {row["name"] for row in self.db.execute("PRAGMA table_info(entries)")}
+            for column in ("url", "target"):
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE entries ADD COLUMN {column} TEXT")
+            # and the failed sync attempts of the manifests
+            columns = {row["name"] for row in self.db.execute("PRAGMA table_info(manifests)")}
+            if "attempts" not in columns:
+                self.db.execute(
+                    "ALTER TABLE manifests ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+                )
+
+    def add_job(self, job):
+        options = {
+            "folder": job.folder,
+            "custom_filename": job.custom_filename,
+            "format_type": job.format_type,
+            "subfolder": job.subfolder,
+            "use_cache": job.use_cache,
+            "sync": job.sync,
+            "profile": job.profile,
+        }
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, NULL)",
+                (job.id, job.username, json.dumps(options), job.status, job.created),
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO urls VALUES (?, ?, ?, 'queued')",
+                [(job.id, i, url) for i, url in enumerate(job.urls, start=1)],
+            )
+
+    def add_spans(self, job_id, spans):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO spans VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (job_id, span["index"], span["entry"], span["name"], span["start"], span["end"])
+                    for span in spans
+                ],
+            )
+
+    def timeline(self, job_id):
+        """Returns owner, creation time and spans of a stored job, None if it does not exist."""
+        with self.lock:
+            job = self.db.execute(
+                "SELECT username, created FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if not job:
+                return None
+            spans = self.db.execute(
+                'SELECT idx AS "index", video_id AS entry, name, start, end '
+                "FROM spans WHERE job_id = ? ORDER BY start",
+                (job_id,),
+            ).fetchall()
+        return job["username"], job["created"], [dict(span) for span in spans]
+
+    def owner(self, job_id):
+        with self.lock:
+            job = self.db.execute(
+                "SELECT username FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return job and job["username"]
+
+    def set_job_status(self, job_id, status, finished=None):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ?",
+                (status, finished, job_id),
+            )
+
+    def set_url_status(self, job_id, idx, status):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE urls SET status = ? WHERE job_id = ? AND idx = ?",
+                (status, job_id, idx),
+            )
+
+    def add_entries(self, job_id, idx, entries):
+        """Records the planned entries of a URL (PlanEntry)."""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO entries (job_id, idx, video_id, title, status, updated, url, target) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (job_id, idx, video_id) DO UPDATE SET "
+                "title = excluded.title, status = excluded.status, updated = excluded.updated, "
+                "url = excluded.url, target = excluded.target",
+                [
+                    (
+                        job_id,
+                        idx,
+                        entry.id,
+                        entry.title,
+                        entry.status,
+                        now,
+                        entry.url,
+                        entry.filename and os.path.basename(entry.filename),
+                    )
+                    for entry in entries
+                ],
+            )
+
+    def plan(self, job_id, idx=None, status=None, offset=0, limit=PLAN_PAGE_SIZE):
+        """Returns the number of planned entries of a job and one page of them, in playlist order."""
+        where, params = "job_id = ?", [job_id]
+        if idx is not None:
+            where += " AND idx = ?"
+            params.append(idx)
+        if status:
+            where += " AND status = ?"
+            params.append(status)
+        with self.lock:
+            total = self.db.execute(
+                f"SELECT COUNT(*) FROM entries WHERE {where}", params
+            ).fetchone()[0]
+            rows = self.db.execute(
+                "SELECT idx, video_id AS id, url, title, target, status, error "
+                f"FROM entries WHERE {where} ORDER BY idx, rowid LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+        return total, [dict(row) for row in rows]
+
+    def set_entry_status(self, job_id, idx, video_id, status, error=None):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE entries SET status = ?, error = ?, updated = ? "
+                "WHERE job_id = ? AND idx = ? AND video_id = ?",
+                (status, error, time.time(), job_id, idx, video_id),
+            )
+
+    def manifest_ids(self, playlist_id, target, format_type):
+        """
+        Returns the IDs of a playlist that were already synced into `target`.
+        Failed entries are only included after SYNC_RETRIES attempts, their
+        retrieval may have failed for a passing reason (429, network).
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT video_id FROM manifests "
+                "WHERE playlist_id = ? AND target = ? AND format_type = ? "
+                "AND (status != 'failed' OR attempts >= ?)",
+                (playlist_id, target, format_type, SYNC_RETRIES),
+            ).fetchall()
+        return {row["video_id"] for row in rows}
+
+    def add_to_manifest(self, playlist_id, target, format_type, entries):
+        """Records synced entries as (video_id, status) tuples, counting the failed attempts."""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO manifests "
+                "(playlist_id, target, format_type, video_id, status, updated, attempts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (playlist_id, target, format_type, video_id) DO UPDATE SET "
+                "status = excluded.status, updated = excluded.updated, "
+                "attempts = CASE WHEN excluded.status = 'failed' "
+                "THEN manifests.attempts + 1 ELSE 0 END",
+                [
+                    (playlist_id, target, format_type, vid, status, now, int(status == "failed"))
+                    for vid, status in entries
+                ],
+            )
+
+    def done_entries(self, job_id, idx):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT video_id FROM entries WHERE job_id = ? AND idx = ? AND status = 'done'",
+                (job_id, idx),
+            ).fetchall()
+        return {row["video_id"] for row in rows}
+
+    def unfinished_jobs(self):
+        """Returns the stored jobs that were queued or running, with their open URLs."""
+        with self.lock:
+            jobs = self.db.execute(
+                "SELECT * FROM jobs WHERE status IN ('queued', 'running') ORDER BY created"
+            ).fetchall()
+            result = []
+            for job in jobs:
+                urls = self.db.execute(
+                    "SELECT idx, url, status FROM urls WHERE job_id = ? ORDER BY idx",
+                    (job["id"],),
+                ).fetchall()
+                result.append((dict(job), [dict(url) for url in urls]))
+        return result
+
+    def job_details(self, job_id):
+        with self.lock:
+            urls = self.db.execute(
+                "SELECT idx, url, status FROM urls WHERE job_id = ? ORDER BY idx",
+                (job_id,),
+            ).fetchall()
+            counts = self.db.execute(
+                "SELECT status, COUNT(*) AS n FROM entries WHERE job_id = ? GROUP BY status",
+                (job_id,),
+            ).fetchall()
+        return {
+            "urls": [dict(url) for url in urls],
+            "entries": {row["status"]: row["n"] for row in counts},
+        }
+
+
+store = JobStore(JOBS_DB)
+
+
+# --- Library Index ---
+def read_video_id(path):
+    """Reads the YouTube ID from the URL yt-dlp writes into the comment tag."""
+    try:
+        tags = mutagen.File(path).tags
+    except Exception:
+        tags = None
+    if tags is None and path.lower().endswith(".mp3"):
+        try:
+            tags = ID3(path)
+        except Exception:
+            return None
+    if not tags:
+        return None
+    # Only the tags with the URL of the video itself, the description may link other videos
+    for key, value in tags.items():
+        key = key.lower()
+        if not (key == "comment" or key.startswith("comm:") or key.endswith("purl") or key == "©cmt"):
+            continue
+        for match in re.findall(r"(?:https?://)?[\w.]*youtu[\w./?=&-]+", str(value)):
+            key = youtube_key(match)
+            if key and key[0] == "video":
+                return key[1]
+    return None
+
+
+class LibraryIndex:
+    """
+    SQLite index of the downloaded files (video ID, path, format, size, mtime)
+    in all folders, so existence checks do not have to list directories.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    dir TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    video_id TEXT,
+                    format TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_video ON files (video_id, format);
+                CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+                CREATE TABLE IF NOT EXISTS scanned (
+                    dir TEXT PRIMARY KEY,
+                    scanned REAL NOT NULL,
+                    mtime REAL
+                );
+                """
+            )
+            # Indexes of older versions lack the mtime of the scanned folders
+            columns = {row["name"] for row in self.db.execute("PRAGMA table_info(scanned)")}
+            if "mtime" not in columns:
+                self.db.execute("ALTER TABLE scanned ADD COLUMN mtime REAL")
+
+    def _row(self, path, video_id, stat):
+        path = os.path.abspath(path)
+        return (
+            path,
+            os.path.dirname(path),
+            os.path.basename(path),
+            video_id,
+            os.path.splitext(path)[1][1:].lower(),
+            stat.st_size,
+            stat.st_mtime,
+        )
+
+    @staticmethod
+    def folder_mtime(folder):
+        """The mtime of `folder` before the app moves a file into it, see `moved`."""
+        try:
+            return os.stat(folder).st_mtime
+        except OSError:
+            return None
+
+    def _moved(self, folder, before):
+        # The folder only changed by the app's own move if it was unchanged
+        # since the last scan before, then names_in does not have to rescan it
+        if before is not None:
+            self.db.execute(
+                "UPDATE scanned SET mtime = ? WHERE dir = ? AND mtime = ?",
+                (self.folder_mtime(folder), folder, before),
+            )
+
+    def moved(self, folder, before):
+        """Records that the app moved a file that is not indexed (e.g. a poster) into `folder`."""
+        with self.lock, self.db:
+            self._moved(os.path.abspath(folder), before)
+
+    def add(self, path, video_id, before=None):
+        """Indexes a file the app moved into its folder, `before` is the folder_mtime before the move."""
+        row = self._row(path, video_id, os.stat(path))
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            self._moved(row[1], before)
+
+    def scan(self, folder, recursive=True, reread=False):
+        """
+        Indexes the media files in `folder`. Tags are only read for new or
+        changed files (all files with `reread`), files that no longer exist
+        are removed from the index. Returns the number of indexed files.
+        """
+        folder = os.path.abspath(folder)
+        count = 0
+        for root, dirs, files in os.walk(folder):
+            with self.lock:
+                known = {
+                    row["path"]: row
+                    for row in self.db.execute("SELECT * FROM files WHERE dir = ?", (root,))
+                }
+            rows = []
+            for name in files:
+                if os.path.splitext(name)[1][1:].lower() not in LIBRARY_FORMATS:
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                row = known.pop(path, None)
+                if (
+                    row
+                    and not reread
+                    and row["size"] == stat.st_size
+                    and row["mtime"] == stat.st_mtime
+                ):
+                    count += 1
+                    continue
+                rows.append(self._row(path, read_video_id(path), stat))
+            with self.lock, self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                self.db.executemany(
+                    "DELETE FROM files WHERE path = ?", [(path,) for path in known]
+                )
+                self.db.execute(
+                    "INSERT OR REPLACE INTO scanned (dir, scanned, mtime) VALUES (?, ?, ?)",
+                    (root, time.time(), os.stat(root).st_mtime),
+                )
+            count += len(rows)
+            if not recursive:
+                break
+        return count
+
+    def names_in(self, folder):
+        """
+        Returns the names of the indexed files in `folder`. The folder is
+        scanned again when it changed outside the app since the last scan,
+        e.g. when files were deleted by hand.
+        """
+        folder = os.path.abspath(folder)
+        try:
+            mtime = os.stat(folder).st_mtime
+        except FileNotFoundError:
+            return set()
+        with self.lock:
+            scanned = self.db.execute(
+                "SELECT mtime FROM scanned WHERE dir = ?", (folder,)
+            ).fetchone()
+        if not scanned or scanned["mtime"] != mtime:
+            self.scan(folder, recursive=False)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name FROM files WHERE dir = ?", (folder,)
+            ).fetchall()
+        return {row["name"] for row in rows}
+
+    def existing_ids(self, video_ids, format_type):
+        """Returns the IDs of `video_ids` that exist as `format_type` in any folder."""
+        video_ids = [vid for vid in set(video_ids) if vid]
+        found = {}
+        with self.lock:
+            for i in range(0, len(video_ids), 500):
+                chunk = video_ids[i : i + 500]
+                rows = self.db.execute(
+                    f"SELECT video_id, path FROM files WHERE format = ? "
+                    f"AND video_id IN ({','.join('?' * len(chunk))})",
+                    (format_type, *chunk),
+                ).fetchall()
+                found.update((row["video_id"], row["path"]) for row in rows)
+        # Only the hits are checked on disk, files deleted by hand are downloaded again
+        missing = [path for path in found.values() if not os.path.exists(path)]
+        if missing:
+            with self.lock, self.db:
+                self.db.executemany(
+                    "DELETE FROM files WHERE path = ?", [(path,) for path in missing]
+                )
+        return {vid for vid, path in found.items() if path not in missing}
+
+
+library = LibraryIndex(LIBRARY_DB)
+
+
+# --- Job Engine ---
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads that are working for a job every
+    PROFILE_INTERVAL seconds. The profile is written in the collapsed stack
+    format ("frame;frame;frame count") that flame graph tools read.
+    """
+
+    def __init__(self, job, interval=PROFILE_INTERVAL):
+        self.job = job
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name=f"profiler-{job.id}", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            with self.job.lock:
+                threads = set(self.job.threads)
+            for thread, frame in sys._current_frames().items():
+                if thread not in threads:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stops sampling and saves the profile, returns its path."""
+        self.stopped.set()
+        self.thread.join()
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        path = os.path.join(PROFILES_DIR, f"{self.job.id}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+class DownloadJob:
+    """State of one submitted batch of URLs."""
+
+    def __init__(
+        self,
+        username,
+        urls,
+        folder,
+        custom_filename,
+        format_type,
+        subfolder,
+        use_cache,
+        sync=False,
+        profile=False,
+        job_id=None,
+    ):
+        self.id = job_id or uuid.uuid4().hex[:8]
+        self.username = username
+        self.urls = urls
+        self.folder = folder
+        self.custom_filename = custom_filename
+        self.format_type = format_type
+        self.subfolder = subfolder
+        self.use_cache = use_cache
+        self.sync = sync
+        self.profile = profile
+        self.profiler = None
+        self.status = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.pending = len(urls)
+        self.to_download = 0
+        self.done_download = 1
+        self.progress = {}
+        self.last_progress = 0
+        # Stage, its start and the last activity of every thread working for this job
+        self.stages = {}
+        self.heartbeat = None
+        self.cancelled = False
+        self.claimed_ids = set()
+        self.moved_files = []
+        self.missing_files = []
+        self.unavailable_videos = []
+        self.spans = []
+        # Threads that are currently working for this job, with their open spans
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, index=None, entry=None):
+        """Records the time of a stage of the job (for a URL index / entry) in its timeline."""
+        thread = threading.get_ident()
+        with self.lock:
+            self.threads[thread] = self.threads.get(thread, 0) + 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, index, entry)
+            with self.lock:
+                self.threads[thread] -= 1
+                if not self.threads[thread]:
+                    del self.threads[thread]
+
+    def add_span(self, name, start, index=None, entry=None):
+        """Records a stage that started at `start` and ends now."""
+        span = {"index": index, "entry": entry, "name": name, "start": start, "end": time.time()}
+        with self.lock:
+            self.spans.append(span)
+
+    def timeline(self):
+        with self.lock:
+            return sorted(self.spans, key=lambda span: span["start"])
+
+    def claim(self, video_id):
+        """Claims a video for this job, False if another URL of the job already has it."""
+        with self.lock:
+            if video_id in self.claimed_ids:
+                return False
+            self.claimed_ids.add(video_id)
+            return True
+
+    def log(self, message, box=True, framed=False):
+        log_message(f"[{self.id}] {message}", box, framed, self.id)
+
+    def report_progress(self, d, stage="download", force=False):
+        """
+        Publishes the progress of the current download as a compact event.
+        Updates within PROGRESS_INTERVAL are skipped, the next one carries
+        the latest state anyway.
+        """
+        now = time.monotonic()
+        state = self.stages.get(threading.get_ident())
+        # Only new bytes count as progress, not the updates while yt-dlp retries
+        if state and d.get("downloaded_bytes") != state[3]:
+            state[2], state[3] = now, d.get("downloaded_bytes")
+        if not force and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        info = d.get("info_dict") or {}
+        self.progress = {
+            "job": self.id,
+            "entry": info.get("id"),
+            "title": info.get("title"),
+            "index": self.done_download,
+            "count": self.to_download,
+            "downloaded": d.get("downloaded_bytes"),
+            "total": d.get("total_bytes") or d.get("total_bytes_estimate"),
+            "speed": d.get("speed"),
+            "eta": d.get("eta"),
+            "stage": stage,
+        }
+        broadcaster.publish_state(json.dumps(self.progress), self.id, "progress")
+
+    def set_stage(self, stage):
+        """
+        Sets the stage of the calling thread. Downloads, conversions and moves
+        of a job run in different threads at the same time, each has its own.
+        None when the thread stops working for this job.
+        """
+        thread = threading.get_ident()
+        now = time.monotonic()
+        with self.lock:
+            if stage is None:
+                self.stages.pop(thread, None)
+            elif self.stages.get(thread, [None])[0] != stage:
+                self.stages[thread] = [stage, now, now, None]
+
+    def check_stalled(self):
+        """Raises DownloadStalled in the calling thread if its download had no progress for STALL_ABORT seconds."""
+        state = self.stages.get(threading.get_ident())
+        if state and state[0] == "download":
+            idle = int(time.monotonic() - state[2])
+            if idle >= STALL_ABORT:
+                raise DownloadStalled(f"No download progress for {idle}s")
+
+    def check_stage(self):
+        """Called by the scheduler: heartbeats for long stages and stall detection."""
+        now = time.monotonic()
+        with self.lock:
+            stages = [list(state) for state in self.stages.values()]
+        elapsed = {}
+        for stage, started, last_activity, _ in stages:
+            # Downloads are checked for progress, the other stages for their duration
+            since = last_activity if stage == "download" else started
+            elapsed[stage] = max(elapsed.get(stage, 0), int(now - since))
+        if elapsed.get("retrieve", 0) > 5:
+            self.log(f"⏳ Still retrieving... {elapsed['retrieve']}s elapsed", True)
+        if elapsed.get("convert", 0) > 5:
+            self.log(f"⏳ Still working... {elapsed['convert']}s elapsed", True)
+        if elapsed.get("download", 0) >= STALL_TIMEOUT:
+            self.log(f"⚠️ No download progress for {elapsed['download']}s, still waiting...", True)
+
+    def set_status(self, status):
+        # Several download workers can start URLs of the same job at once,
+        # only the first one starts the heartbeat and the profiler.
+        with self.lock:
+            if status == "running":
+                if self.status == "running":
+                    return
+                if not self.heartbeat:
+                    self.heartbeat = scheduler.call_every(HEARTBEAT_INTERVAL, self.check_stage)
+                if self.profile and not self.profiler:
+                    self.profiler = SamplingProfiler(self)
+                    self.profiler.start()
+            elif status in ("done", "cancelled") and self.heartbeat:
+                self.heartbeat.cancel()
+            self.status = status
+            store.set_job_status(self.id, status, self.finished)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.status == "queued":
+            self.set_status("cancelled")
+
+    def finish(self):
+        """Reports the summary of the job once all of its URLs are processed."""
+        complete_msg = ""
+        if self.moved_files:
+            complete_msg += f"✅ Download completed:<br>{'<br>'.join(self.moved_files)}<br>Total: {len(self.moved_files)}<br>"
+        if self.missing_files:
+            complete_msg += f"<br>❓ Download failed:<br>{'<br>'.join(self.missing_files)}<br>Total: {len(self.missing_files)}<br>"
+        if self.unavailable_videos:
+            complete_msg += f"<br>❌ There are <strong>{len(self.unavailable_videos)}</strong> Videos that cant be downloaded.<br>"
+        if self.cancelled:
+            complete_msg += "<br>🚫 Download canceled (by User)<br>"
+
+        self.finished = time.time()
+        store.add_spans(self.id, self.spans)
+        if self.profiler:
+            path = self.profiler.stop()
+            self.log(f"🔬 Profile saved: {path}")
+        self.set_status("cancelled" if self.cancelled else "done")
+        my_hook({"status": "complete", "msg": complete_msg}, self)
+        broadcaster.publish(self.status, self.id, "done")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "status": self.status,
+            "urls": len(self.urls),
+            "pending": self.pending,
+            "to_download": self.to_download,
+            "done_download": self.done_download - 1,
+            "moved": len(self.moved_files),
+            "missing": len(self.missing_files),
+            "unavailable": len(self.unavailable_videos),
+            "progress": self.progress,
+            "position": engine.tasks.positions.get(self.id),
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class Stage:
+    """
+    A step of the download pipeline: worker threads processing the items of a
+    bounded queue. `put` blocks while the queue is full, so a fast stage waits
+    for a slower one instead of piling up files in the output folder.
+    """
+
+    def __init__(self, name, workers, size, handler):
+        self.name = name
+        self.workers = workers
+        self.handler = handler
+        self.items = queue.Queue(maxsize=size)
+        self.threads = []
+        self.busy = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker, name=f"{self.name}-worker-{i + 1}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, item):
+        self.start()
+        self.items.put(item)
+
+    def _worker(self):
+        while True:
+            item = self.items.get()
+            with self.lock:
+                self.busy += 1
+            try:
+                with working_for(item.task.job):
+                    try:
+                        self.handler(item)
+                    except Exception as e:
+                        log_message(f"⚠️ Error in {self.name} stage: {e}", True, True)
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                self.items.task_done()
+
+
+class FairQueue:
+    """
+    The URL tasks waiting for a download worker, one queue per user. The
+    workers serve the users in turn, weighted by USER_WEIGHTS (smooth weighted
+    round robin), users that already download USER_MAX_ENTRIES entries are
+    skipped. The queue position of every waiting job is published to its clients.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.running = collections.Counter()
+        self.current = collections.Counter()
+        self.positions = {}
+        self.cond = threading.Condition()
+
+    def weight(self, username):
+        return USER_WEIGHTS.get(username, 1)
+
+    def put(self, task, first=False):
+        """Queues a task, `first` puts it before the other tasks of its user."""
+        with self.cond:
+            tasks = self.queues.setdefault(task.job.username, collections.deque())
+            if first:
+                tasks.appendleft(task)
+            else:
+                tasks.append(task)
+            self.cond.notify_all()
+            self._publish()
+
+    def get(self):
+        """Waits for the next task and counts it as running for its user."""
+        with self.cond:
+            while True:
+                users = [
+                    user
+                    for user, tasks in self.queues.items()
+                    if tasks and self.running[user] < USER_MAX_ENTRIES
+                ]
+                if users:
+                    break
+                self.cond.wait()
+            user = self._pick(users, self.current)
+            task = self.queues[user].popleft()
+            self.running[user] += 1
+            self._publish()
+            return task
+
+    def done(self, username):
+        with self.cond:
+            self.running[username] -= 1
+            self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return sum(len(tasks) for tasks in self.queues.values())
+
+    def others_waiting(self, username):
+        """True if tasks of other users wait and could run."""
+        with self.cond:
+            return any(
+                tasks and user != username and self.running[user] < USER_MAX_ENTRIES
+                for user, tasks in self.queues.items()
+            )
+
+    def bandwidth(self, username):
+        """The ratelimit of a download of `username`: its share of BANDWIDTH_LIMIT."""
+        if not BANDWIDTH_LIMIT:
+            return None
+        with self.cond:
+            active = [user for user, n in self.running.items() if n]
+            total = sum(self.weight(user) for user in active) or 1
+            share = BANDWIDTH_LIMIT * self.weight(username) / total
+            return share / max(self.running[username], 1)
+
+    def _pick(self, users, current):
+        total = 0
+        for user in users:
+            current[user] += self.weight(user)
+            total += self.weight(user)
+        user = max(users, key=lambda user: current[user])
+        current[user] -= total
+        return user
+
+    def _publish(self):
+        """Projects the order of the waiting tasks and publishes changed positions."""
+        remaining = {user: len(tasks) for user, tasks in self.queues.items() if tasks}
+        current = collections.Counter(self.current)
+        positions = {}
+        position = 0
+        while remaining:
+            user = self._pick(list(remaining), current)
+            task = self.queues[user][len(self.queues[user]) - remaining[user]]
+            position += 1
+            positions.setdefault(task.job.id, position)
+            remaining[user] -= 1
+            if not remaining[user]:
+                del remaining[user]
+        for job_id in positions.keys() | self.positions.keys():
+            if positions.get(job_id) != self.positions.get(job_id):
+                message = json.dumps({"job": job_id, "position": positions.get(job_id)})
+                broadcaster.publish_state(message, job_id, "queue")
+        self.positions = positions
+
+
+class UrlTask:
+    """
+    One URL of a job on its way through the pipeline. The download worker and
+    every entry in a later stage hold the task, the last release completes it.
+    """
+
+    def __init__(self, job, index, url):
+        self.job = job
+        self.index = index
+        self.url = url
+        self.output_path = None
+        # Bytes reserved on the RAM disk, if the URL is downloaded there
+        self.reserved = 0
+        self.target_folder = None
+        self.playlist_id = None
+        # The planned entries that are not downloaded yet, None until the URL is planned
+        self.queued = None
+        self.status = "failed"
+        # Files and folders this URL created, their permissions are set at the end
+        self.created = []
+        self.holds = 1
+        self.lock = threading.Lock()
+
+    def hold(self):
+        with self.lock:
+            self.holds += 1
+
+    def release(self):
+        with self.lock:
+            self.holds -= 1
+            done = self.holds == 0
+        if done:
+            self.complete()
+
+    def complete(self):
+        """Cleans up once all entries of the URL are finalized and reports it to the job."""
+        job = self.job
+        try:
+            if self.status == "done" and self.target_folder and self.output_path:
+                image_extensions = [".jpg", ".png", ".webp"]
+
+                # Check for any remaining images in the folder
+                remaining_files = os.listdir(self.output_path)
+                image_files = [
+                    f
+                    for f in remaining_files
+                    if any(f.lower().endswith(ext) for ext in image_extensions)
+                ]
+
+                for image_file in image_files:
+                    poster_path = os.path.join(
+                        self.target_folder, "poster" + os.path.splitext(image_file)[1]
+                    )
+                    start = time.monotonic()
+                    before = library.folder_mtime(self.target_folder)
+                    with job.span("move", self.index):
+                        move_file(os.path.join(self.output_path, image_file), poster_path)
+                    library.moved(self.target_folder, before)
+                    finalize_seconds.observe(time.monotonic() - start, step="move")
+                    self.created.append(poster_path)
+
+            start = time.monotonic()
+            with job.span("chown", self.index):
+                set_owner(self.created)
+            finalize_seconds.observe(time.monotonic() - start, step="chown")
+        except Exception as e:
+            job.log(f"⚠️ INFO ⚠️ Error:<br>{str(e)}", True, True)
+        finally:
+            if self.output_path:
+                shutil.rmtree(self.output_path, ignore_errors=True)
+            engine.release_scratch(self.reserved)
+            store.set_url_status(job.id, self.index, self.status)
+            with job.lock:
+                job.pending -= 1
+                done = job.pending == 0
+            if done:
+                engine.finish(job)
+
+
+class DownloadEngine:
+    """Runs the URLs of all submitted jobs on a bounded pool of worker threads."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.tasks = FairQueue()
+        self.jobs = {}
+        self.threads = []
+        self.busy = 0
+        self.scratch_used = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker, name=f"download-worker-{i + 1}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, job, urls=None):
+        """Queues the URLs of a job, `urls` are the (index, url) pairs still to do."""
+        self.start()
+        if urls is None:
+            store.add_job(job)
+            urls = list(enumerate(job.urls, start=1))
+        job.pending = len(urls)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        for i, url in urls:
+            self.tasks.put(UrlTask(job, i, url))
+        position = self.tasks.positions.get(job.id)
+        if position and position > self.workers - self.busy:
+            job.log(f"🕒 Waiting for a free download slot, position {position} in the queue", True)
+        return job
+
+    def resume(self):
+        """Queues the unfinished work of the stored jobs again, e.g. after a restart."""
+        resumed = []
+        for row, urls in store.unfinished_jobs():
+            options = json.loads(row["options"])
+            # The info of resumed jobs was already retrieved and cached
+            options["use_cache"] = "true"
+            job = DownloadJob(
+                row["username"], [url["url"] for url in urls], job_id=row["id"], **options
+            )
+            job.created = row["created"]
+            open_urls = [
+                (url["idx"], url["url"]) for url in urls if url["status"] != "done"
+            ]
+            if not open_urls:
+                self.finish(job)
+                continue
+            job.log(f"♻️ Resuming job with {len(open_urls)} open URLs", True, True)
+            self.submit(job, open_urls)
+            resumed.append(job)
+        return resumed
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def workspace(self, job, tmpfs=False):
+        """
+        The scratch folder of a job (on the RAM disk or in its staging folder),
+        created on first use and removed when the job is finished.
+        """
+        root = SCRATCH_TMPFS if tmpfs else staging_paths.get(job.folder, OUTPUT_DIR)
+        return os.path.join(root, job.username, job.id)
+
+    def reserve_scratch(self, size):
+        """Reserves `size` bytes on the RAM disk, False if this would exceed the quota."""
+        if not SCRATCH_TMPFS:
+            return False
+        with self.lock:
+            if self.scratch_used + size > SCRATCH_TMPFS_QUOTA:
+                return False
+            self.scratch_used += size
+            return True
+
+    def release_scratch(self, size):
+        if size:
+            with self.lock:
+                self.scratch_used -= size
+
+    def finish(self, job):
+        """Removes the scratch folders of a job once all of its URLs are processed."""
+        for tmpfs in (False, True) if SCRATCH_TMPFS else (False,):
+            shutil.rmtree(self.workspace(job, tmpfs), ignore_errors=True)
+        job.finish()
+
+    def user_jobs(self, username):
+        return [job for job in self.jobs.values() if job.username == username]
+
+    def _prune(self):
+        finished = sorted(
+            (job for job in self.jobs.values() if job.finished),
+            key=lambda job: job.finished,
+        )
+        for job in finished[: max(len(finished) - JOB_HISTORY, 0)]:
+            del self.jobs[job.id]
+            broadcaster.drop(job.id)
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            job, index, url = task.job, task.index, task.url
+            with working_for(job):
+                paused = False
+                with self.lock:
+                    self.busy += 1
+                try:
+                    if not job.cancelled:
+                        if job.status != "running":
+                            job.set_status("running")
+                        if task.queued is None:
+                            store.set_url_status(job.id, index, "running")
+                            job.log(
+                                f"🔹 [{index}/{len(job.urls)}] Start Download for:<br>{url}",
+                                True,
+                                True,
+                            )
+                        with job.span("url", index):
+                            result = download_task(task, app)
+                        paused = bool(result and result.get("paused"))
+                        if not (result and "error" in result):
+                            task.status = "done"
+                except Exception as e:
+                    job.log(f"⚠️ INFO ⚠️ Error:<br>{str(e)}", True, True)
+                finally:
+                    job.set_stage(None)
+                    with self.lock:
+                        self.busy -= 1
+                    self.tasks.done(job.username)
+                    if paused:
+                        # The rest of the URL waits for its next turn, the task stays held
+                        self.tasks.put(task, first=True)
+                    else:
+                        # Entries still being converted or moved complete the task later
+                        task.release()
+
+
+engine = DownloadEngine(DOWNLOAD_WORKERS)
+
+
 # --- Authentication ---
+class CredentialCache:
+    """
+    Remembers verified credentials for `ttl` seconds, so the (slow) scrypt hash
+    is not checked on every request. Entries are keyed by an HMAC of username
+    and password with a random per-process key, the password is not kept.
+    """
+
+    def __init__(self, ttl, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key = os.urandom(32)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _digest(self, username, password):
+        message = f"{username}\0{password}".encode("utf-8")
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    def get(self, username, password):
+        digest = self._digest(username, password)
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+            self.entries.pop(digest, None)
+        return None
+
+    def add(self, username, password):
+        digest = self._digest(username, password)
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[digest] = (username, time.monotonic() + self.ttl)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+credential_cache = CredentialCache(AUTH_CACHE_TTL)
+
+
+def refresh_users():
+    """Reloads users.json when it was changed (e.g. by manage_app_users.py)."""
+    global users, users_stamp
+    try:
+        stat = os.stat(USERS_FILE)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        stamp = None
+    if stamp != users_stamp:
+        users = load_users()
+        users_stamp = stamp
+        credential_cache.clear()
+
+
 @auth.verify_password
 def verify_password(username, password):
+    refresh_users()
+    if credential_cache.get(username, password) == username:
+        return username
     if username in users and check_password_hash(users[username]["p"], password):
+        credential_cache.add(username, password)
         log_message(f"User '{username}' logged in.", False)
         return username
     return None
@@ -410,8 +2536,6 @@ def serve_lang_json(lang):
 @app.route("/download", methods=["POST"])
 @auth.login_required
 def download():
-    global cancel_flag
-    cancel_flag = False
     urls = request.form["url"].strip().split("\n")
     urls = [url.strip() for url in urls if url.strip()]
     folder = request.form["folder"]
@@ -419,13 +2543,19 @@ def download():
     format_type = request.form["format_type"]
     subfolder = request.form["subfolder"]
     use_cache = request.form["use_cache"]
+    sync = request.form.get("sync") == "true"
+    # Runs the job under the sampling profiler, see PROFILES_DIR
+    profile = request.form.get("profile") == "true"
 
     invalid_urls = [url for url in urls if not is_valid_youtube_url(url)]
     if invalid_urls:
         return jsonify({"error": f"Invalid URLs found: {', '.join(invalid_urls)}"}), 400
+    # Different URLs of the same video or playlist are only processed once
+    received = len(urls)
+    urls = list(dict.fromkeys(canonical_url(url) for url in urls))
     if folder not in folder_paths:
         return jsonify({"error": "Invalid folder selected! ⚠️"}), 400
-    if format_type not in ["mp3", "mp4"]:
+    if format_type not in OUTPUT_FORMATS:
         return jsonify({"error": f'Invalid format selected! "{format_type}" ⚠️'}), 400
     if subfolder == "New" and not request.form.get("new_subfolder"):
         return jsonify({"error": "You have not set a name for the new folder! ⚠️"}), 400
@@ -440,367 +2570,733 @@ def download():
     if playlist_urls and request.form.get("custom_filename"):
         return jsonify({"error": "Playlists do not support custom filenames! ⚠️"}), 400
 
-    log_message(f"❇️ Received {len(urls)} YouTube URLs", True)
-
-    log_message(
+    username = auth.current_user()
+    job = DownloadJob(
+        username,
+        urls,
+        folder,
+        custom_filename,
+        format_type,
+        subfolder,
+        use_cache,
+        sync,
+        profile,
+    )
+    job.log(f"❇️ Received {received} YouTube URLs", True)
+    if received > len(urls):
+        job.log(f"🆗 Skipping {received - len(urls)} duplicate URLs", True)
+    job.log(
         f"Preparing download...<br>⚠️ INFO ⚠️<br>Site can be closed, process will complete in background.",
         True,
         True,
     )
-    time.sleep(0.3)
-    username = auth.current_user()
-    def process_downloads_sequentially(urls, folder, custom_filename, format_type, subfolder, username, use_cache, app):
-        global complete_msg, moved_files, missing_files, unavailable_videos
-        moved_files = []
-        missing_files = []
-        unavailable_videos = []
-        complete_msg = ''
-        for i, url in enumerate(urls, start=1):
-            log_message(f"🔹 [{i}/{len(urls)}] Start Download for:<br>{url}", True, True)
-
-            thread = threading.Thread(
-                target=download_task,
-                args=(url, folder, custom_filename, format_type, subfolder, username, use_cache, app),
-            )
-            thread.start()
-            thread.join()
+    engine.submit(job)
 
-        if moved_files:
-            complete_msg += f"✅ Download completed:<br>{'<br>'.join(moved_files)}<br>Total: {len(moved_files)}<br>"
-        if missing_files:
-            complete_msg += f"<br>❓ Download failed:<br>{'<br>'.join(missing_files)}<br>Total: {len(missing_files)}<br>"
-        if unavailable_videos:
-            complete_msg += f"<br>❌ There are <strong>{len(unavailable_videos)}</strong> Videos that cant be downloaded.<br>"
-            
+    return jsonify({"success": True, "message": "Download started...", "job_id": job.id})
 
-        my_hook({"status": "complete", "msg": complete_msg})
 
-    threading.Thread(
-        target=process_downloads_sequentially,
-        args=(urls, folder, custom_filename, format_type, subfolder, username, use_cache, current_app._get_current_object()),
-        daemon=True
-    ).start()
+@app.route("/jobs", methods=["GET"])
+@auth.login_required
+def list_jobs():
+    jobs = sorted(engine.user_jobs(auth.current_user()), key=lambda job: job.created)
+    return jsonify([job.to_dict() for job in jobs])
 
-    return jsonify({"success": True, "message": "Download started..."})
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@auth.login_required
+def job_details(job_id):
+    job = engine.get_job(job_id)
+    if not job or job.username != auth.current_user():
+        return jsonify({"error": "Job not found! ⚠️"}), 404
+    return jsonify({**job.to_dict(), **store.job_details(job_id)})
+
+
+@app.route("/jobs/<job_id>/timeline", methods=["GET"])
+@auth.login_required
+def job_timeline(job_id):
+    job = engine.get_job(job_id)
+    if job and job.username == auth.current_user():
+        created, spans = job.created, job.timeline()
+    else:
+        stored = store.timeline(job_id)
+        if not stored or stored[0] != auth.current_user():
+            return jsonify({"error": "Job not found! ⚠️"}), 404
+        _, created, spans = stored
+    profile = os.path.join(PROFILES_DIR, f"{job_id}.txt")
+    return jsonify(
+        {
+            "id": job_id,
+            "created": created,
+            "spans": [
+                {
+                    **span,
+                    "offset": round(span["start"] - created, 3),
+                    "duration": round(span["end"] - span["start"], 3),
+                }
+                for span in spans
+            ],
+            "profile": f"/jobs/{job_id}/profile" if os.path.exists(profile) else None,
+        }
+    )
+
+
+@app.route("/jobs/<job_id>/plan", methods=["GET"])
+@auth.login_required
+def job_plan(job_id):
+    """
+    Pages through the planned entries of a job with `?offset=` and `?limit=`,
+    `?index=` (URL) and `?status=` filter them.
+    """
+    if store.owner(job_id) != auth.current_user():
+        return jsonify({"error": "Job not found! ⚠️"}), 404
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", PLAN_PAGE_SIZE, type=int), 1), PLAN_PAGE_SIZE)
+    total, entries = store.plan(
+        job_id,
+        request.args.get("index", type=int),
+        request.args.get("status"),
+        offset,
+        limit,
+    )
+    return jsonify(
+        {
+            "id": job_id,
+            "counts": store.job_details(job_id)["entries"],
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "next": offset + limit if offset + limit < total else None,
+            "entries": entries,
+        }
+    )
+
+
+@app.route("/jobs/<job_id>/profile", methods=["GET"])
+@auth.login_required
+def job_profile(job_id):
+    stored = store.timeline(job_id)
+    if not stored or stored[0] != auth.current_user():
+        return jsonify({"error": "Job not found! ⚠️"}), 404
+    return send_from_directory(PROFILES_DIR, f"{job_id}.txt", mimetype="text/plain")
+
+
+@app.route("/metrics", methods=["GET"])
+@auth.login_required
+def show_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/cancel", methods=["POST"])
 @auth.login_required
 def cancel_download():
-    global current_download, cancel_flag
-    cancel_flag = True
-    if current_download:
-        current_download.cancel()
-        current_download = None
-        log_message("Download canceled (by yt-dlp).")
+    username = auth.current_user()
+    job_id = request.form.get("job_id")
+    if job_id:
+        job = engine.get_job(job_id)
+        jobs = [job] if job and job.username == username else []
     else:
-        log_message("No active download to cancel (But have set 'Cancel-Flag').")
+        jobs = engine.user_jobs(username)
+    jobs = [job for job in jobs if job.status in ("queued", "running")]
+    for job in jobs:
+        job.cancel()
+        job.log("Download canceled (by User).")
+    if not jobs:
+        log_message("No active download to cancel.")
     return jsonify({"success": True, "message": "Download canceled (by User)"})
 
 
 @app.route("/progress")
+@auth.login_required
 def progress():
-    def generate():
+    """
+    Streams the progress messages as server-sent events.
+    With `?job=<id>` only the messages of that job are sent, starting with
+    the ones that are still buffered. Reconnecting clients continue after
+    the message in their `Last-Event-ID` header.
+    """
+    username = auth.current_user()
+    job_id = request.args.get("job")
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get(
+        "last_event_id"
+    )
+
+    if job_id:
+        job = engine.get_job(job_id)
+        if not job or job.username != username:
+            return jsonify({"error": "Job not found! ⚠️"}), 404
+        visible = lambda key: key == job_id
+    else:
+
+        def visible(key):
+            if key is None:
+                return True
+            job = engine.get_job(key)
+            return bool(job) and job.username == username
+
+    if last_event_id and last_event_id.isdigit():
+        after = int(last_event_id)
+    elif job_id:
+        after = 0
+    else:
+        after = broadcaster.last_id
+
+    def generate(after):
         while True:
+            after, events = broadcaster.read(after, visible, timeout=15)
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event_id, _, event, message in events:
+                if "[HEARTBEAT]" in message:
+                    continue
+                message = message.replace("\n", "<br>")
+                yield f"id: {event_id}\nevent: {event}\ndata: {message}\n\n"
+            # Pace the client here instead of slowing down the producers
+            time.sleep(PROGRESS_PACING)
+
+    return Response(generate(after), mimetype="text/event-stream")
+
+
+def retrieve_info(ydl, url, job):
+    """Returns the info of a URL from the cache (if enabled) or retrieves it."""
+
+    def retrieve():
+        start = time.monotonic()
+        info = ydl.extract_info(url, download=False)
+        extraction_seconds.observe(time.monotonic() - start, mode="full")
+        job.log("♻️ Caching retrieved information...", True)
+        save_to_cache(url, info)
+        return info
+
+    if job.use_cache == "true" or job.use_cache == True:
+        cached_info = load_from_cache(url)
+        if cached_info:
+            job.log("✅ Using cached info. Skipping retrieval.", True)
+            return cached_info
+        job.log("♻️ No cache found. Retrieving info...", True)
+    # Jobs that need the same URL at the same time share one retrieval
+    return inflight_extractions.run(url, retrieve)
+
+
+def retrieve_new_entries(ydl, ydl_opts, url, job, target_folder):
+    """
+    Sync mode: lists the playlist without details and only retrieves the
+    entries that are not yet in the manifest of the playlist for this folder.
+    """
+    with PacedYoutubeDL({**ydl_opts, "extract_flat": "in_playlist"}) as flat_ydl:
+        start = time.monotonic()
+        listing = flat_ydl.extract_info(url, download=False)
+        extraction_seconds.observe(time.monotonic() - start, mode="flat")
+    if not listing:
+        return None
+
+    known = store.manifest_ids(listing["id"], target_folder, job.format_type)
+    listed = [entry for entry in listing.get("entries") or [] if entry]
+    new_entries = [entry for entry in listed if entry.get("id") not in known]
+    job.log(
+        f"🔄 Sync: <strong>{len(new_entries)}</strong> new of {len(listed)} videos in '{listing.get('title')}'",
+        True,
+    )
+
+    entries = []
+    for entry in new_entries:
+        # Private and deleted videos are recorded as unavailable without retrieving them
+        if entry.get("title") in UNAVAILABLE_TITLES:
+            info = None
+        else:
+            info = retrieve_info(ydl, f"https://www.youtube.com/watch?v={entry['id']}", job)
+        if not info:
+            # Keep the ID, so the video is recorded as unavailable
+            info = {
+                "id": entry["id"],
+                "title": entry.get("title") or "Unknown Video",
+                "availability": "unavailable",
+            }
+        entries.append(info)
+
+    return {
+        "_type": "playlist",
+        "id": listing["id"],
+        "title": listing.get("title"),
+        "webpage_url": listing.get("webpage_url"),
+        "entries": entries,
+    }
+
+
+class PlanEntry:
+    """What happens to one entry of a URL: its target file and status (queued, done, failed)."""
+
+    __slots__ = ("id", "url", "title", "filename", "status", "info")
+
+    def __init__(self, video_id, url, title, filename, status, info=None):
+        self.id = video_id
+        self.url = url
+        self.title = title
+        self.filename = filename
+        self.status = status
+        # The info of queued entries, for the download
+        self.info = info
+
+
+class PlaylistPlanner:
+    """
+    Plans the entries of a URL. The output template is evaluated once with a
+    placeholder title, per entry only the title is sanitized like yt-dlp does
+    it. Templates with other fields are evaluated by yt-dlp for every entry.
+    """
+
+    TITLE = "PLANNEDTITLE"
+    # Checked against yt-dlp before the evaluated template is used
+    PROBE = 'Probe: 12:30 "a/b" <c> | d? *e* \\ __ Ünï ＃ ..'
+
+    def __init__(self, ydl, job, existing_files, done_ids):
+        self.ydl = ydl
+        self.job = job
+        self.format_type = job.format_type
+        self.existing_files = existing_files
+        self.done_ids = done_ids
+        self.restricted = ydl.params.get("restrictfilenames")
+        filename = ydl.prepare_filename({"title": self.TITLE, "ext": "ext"})
+        self.prefix, found, self.suffix = filename.partition(self.TITLE)
+        self.template = found and not ydl.params.get("trim_file_name")
+
+    def filename(self, entry):
+        """The path of the converted file of an entry."""
+        title = entry.get("title")
+        if self.template and isinstance(title, str):
+            filename = (
+                self.prefix
+                + yt_dlp.utils.sanitize_filename(title, restricted=self.restricted)
+                + self.suffix
+            )
+        else:
+            filename = self.ydl.prepare_filename(entry)
+        return os.path.splitext(filename)[0].strip() + "." + self.format_type
+
+    def plan(self, info):
+        """Returns a PlanEntry for every entry of a playlist info, or for a single video."""
+        entries = info["entries"] if info and "entries" in info else [info]
+        if self.template:
+            probe = next((entry for entry in entries if entry), {})
+            probe = dict(probe, title=self.PROBE)
+            expected = os.path.splitext(self.ydl.prepare_filename(probe))[0].strip()
+            self.template = self.filename(probe) == f"{expected}.{self.format_type}"
+        # Videos that already exist in this format in any folder
+        library_ids = library.existing_ids(
+            [entry.get("id") for entry in entries if entry], self.format_type
+        )
+        plan = []
+        for entry in entries:
+            if not entry:
+                plan.append(PlanEntry(None, None, "Unknown Video", None, "failed"))
+                continue
+            video_id = entry.get("id", "unknown")
+            url = entry.get("webpage_url") or entry.get("url")
+            title = entry.get("title", "Unknown Video")
+            if entry.get("availability", "") == "unavailable":
+                plan.append(PlanEntry(video_id, url, title, None, "failed"))
+                continue
+            filename = self.filename(entry)
+            if (
+                clean_filename(os.path.basename(filename)) not in self.existing_files
+                and video_id not in self.done_ids
+                and video_id not in library_ids
+                and self.job.claim(video_id)
+            ):
+                plan.append(PlanEntry(video_id, url, title, filename, "queued", entry))
+            else:
+                plan.append(PlanEntry(video_id, url, title, filename, "done"))
+        return plan
+
+
+def ydl_options(job, output_path):
+    """The yt-dlp options for downloading the URLs of a job into `output_path`."""
+    ydl_opts = {
+        "outtmpl": os.path.join(output_path, "%(title)s.%(ext)s"),
+        "socket_timeout": 60,
+        "no_cache_dir": True,
+        "progress_hooks": [functools.partial(my_hook, job=job)],
+        "ignoreerrors": True,
+        "retries": 5,
+        "retry_sleep_functions": {
+            "http": my_retry_sleep,
+            "fragment": my_retry_sleep,
+            "file_access": my_retry_sleep,
+            "extractor": my_retry_sleep,
+        },
+        "writethumbnail": True,
+        "addmetadata": True,
+        "logger": YtdlpLogger(),
+        # The progress is shown in the web UI, the lines of parallel downloads mix up
+        "noprogress": True,
+    }
+
+    if os.path.exists(COOKIES) and os.path.getsize(COOKIES) > 0:
+        ydl_opts["cookiefile"] = COOKIES
+
+    ydl_opts["format"] = OUTPUT_FORMATS[job.format_type]["format"]
+
+    if job.custom_filename:
+        ydl_opts["outtmpl"] = os.path.join(output_path, f"{job.custom_filename}.%(ext)s")
+    return ydl_opts
+
+
+def download_entries(task, ydl):
+    """
+    Downloads the queued entries of a URL and hands them to the pipeline.
+    Pauses after USER_TIME_SLICE seconds if other users wait for a worker.
+    """
+    job = task.job
+    started = time.monotonic()
+    while task.queued:
+        if job.cancelled:
+            raise yt_dlp.utils.DownloadCancelled("Download canceled (by User)")
+        entry = task.queued.popleft()
+        job.set_stage("download")
+        # The share of the user changes with the downloads of the other users
+        ydl.params["ratelimit"] = engine.tasks.bandwidth(job.username)
+        store.set_entry_status(job.id, task.index, entry.id, "running")
+        with job.span("download", task.index, entry.id):
             try:
-                message = progress_queue.get(timeout=1)
-                if "[HEARTBEAT]" not in message:
-                    yield f"data: {message}\n\n"
-            except queue.Empty:
-                yield f"data: \n\n"
-                time.sleep(2)
+                result = download_entry(ydl, entry.info, job)
+            except DownloadStalled as e:
+                job.log(f"⌛ {e}, giving up:<br>{entry.title}", True, True)
+                result = None
+        task.hold()
+        transcode_stage.put(PipelineEntry(task, entry.info, entry.filename, result))
+        if (
+            task.queued
+            and time.monotonic() - started > USER_TIME_SLICE
+            and engine.tasks.others_waiting(job.username)
+        ):
+            job.log(
+                f"⏸️ Other users are waiting, the remaining {len(task.queued)} videos continue later.",
+                True,
+            )
+            return {"paused": True}
+    return {"success": True, "message": "Download finished."}
+
 
-    return Response(generate(), mimetype="text/event-stream")
+def continue_task(task, app):
+    """Downloads the rest of a URL that paused for the downloads of other users."""
+    job = task.job
+    job.log(
+        f"⏯️ [{task.index}/{len(job.urls)}] Continuing with {len(task.queued)} videos", True
+    )
+    with app.app_context():
+        try:
+            with PacedYoutubeDL(ydl_options(job, task.output_path)) as ydl:
+                return download_entries(task, ydl)
+        except yt_dlp.utils.DownloadCancelled:
+            job.log("🚫 Download canceled (by User).", True, True)
+            return {"error": "Download canceled (by User)"}
 
 
-def download_task(
-    url, folder, custom_filename, format_type, subfolder, username, use_cache, app
-):
+def download_task(task, app):
+    job, index, url = task.job, task.index, task.url
+    if task.queued is not None:
+        return continue_task(task, app)
     with app.app_context():
-        global current_download, cancel_flag, is_converting, last_percentage, to_download, done_download, complete_msg, moved_files, missing_files, unavailable_videos
-        time.sleep(0.2)
-        log_message(f"URL set: {url}")
-        time.sleep(0.2)
-        base_path = folder_paths[folder]
+        job.log(f"URL set: {url}")
+        base_path = folder_paths[job.folder]
+        subfolder = job.subfolder
+        format_type = job.format_type
 
         if subfolder == "New":
-            log_message("Did not set name for new folder!", False)
+            job.log("Did not set name for new folder!", False)
             return {"error": "Did not set name for new folder!"}
         elif not subfolder or subfolder == "Others":
             target_folder = os.path.join(base_path, "Others")
         else:
             target_folder = os.path.join(base_path, subfolder)
 
-        log_message(f"📂 Folder set: {target_folder}")
+        job.log(f"📂 Folder set: {target_folder}")
 
+        if not os.path.isdir(target_folder):
+            task.created.append(target_folder)
         os.makedirs(target_folder, exist_ok=True)
-        output_path = os.path.join(OUTPUT_DIR, username)
+        # Every URL gets its own folder in the scratch folder of its job, so
+        # parallel downloads do not delete each others files.
+        output_path = os.path.join(engine.workspace(job), str(index))
         os.makedirs(output_path, exist_ok=True)
+        task.output_path = output_path
+        task.target_folder = target_folder
         os.makedirs(CACHE_DIR, exist_ok=True)
-        clear_output_folder(output_path)
-        time.sleep(0.2)
-        log_message(f"Folder CHK/CLEAN for: '{username}' complete!")
-        time.sleep(0.2)
-
-        existing_files = set(os.listdir(target_folder))
-
-        use_cookies = os.path.exists(COOKIES) and os.path.getsize(COOKIES) > 0
-
-        ydl_opts = {
-            "outtmpl": os.path.join(output_path, "%(title)s.%(ext)s"),
-            "socket_timeout": 60,
-            "no_cache_dir": True,
-            "progress_hooks": [my_hook],
-            "flat_playlist": True,
-            "ignoreerrors": True,
-            "retries": 5,
-            "sleep_interval": 5,
-            "retry_sleep_functions": {
-                "http": my_retry_sleep,
-                "fragment": my_retry_sleep,
-                "file_access": my_retry_sleep,
-                "extractor": my_retry_sleep,
-            },
-            "writethumbnail": True,
-            "postprocessors": [
-                {
-                    "key": "EmbedThumbnail",
-                },
-                {
-                    "key": "FFmpegMetadata",
-                },
-            ],
-            "addmetadata": True,
-        }
+        job.log(f"Folder CHK for: '{job.username}' complete!")
 
-        if use_cookies:
-            ydl_opts["cookiefile"] = COOKIES
+        existing_files = library.names_in(target_folder)
+        # Entries that were already finished by an earlier run of this job
+        done_ids = store.done_entries(job.id, index)
 
-        if format_type == "mp3":
-            ydl_opts["format"] = "bestaudio/best"
-            ydl_opts["postprocessors"].insert(
-                0,
-                {
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "mp3",
-                    "preferredquality": "320",
-                },
-            )
-        else:
-            ydl_opts["format"] = (
-                "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
-            )
-
-        if custom_filename:
-            ydl_opts["outtmpl"] = os.path.join(
-                output_path, f"{custom_filename}.%(ext)s"
-            )
+        ydl_opts = ydl_options(job, output_path)
 
+        retrieving = True
         try:
-            time.sleep(0.2)
-            log_message(
+            job.log(
                 f"♻️ Retrieving Video Details...<br>❗️ This could take a while, please wait...<br>{(20*'-')}",
                 True,
             )
 
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                current_download = ydl
-                retrieving = True
-                start_time = time.time()
-
-                def send_heartbeat():
-                    while retrieving:
-                        elapsed = int(time.time() - start_time)
-                        if elapsed <= 5:
-                            continue
-                        log_message(f"⏳ Still retrieving... {elapsed}s elapsed", True)
-                        time.sleep(10)
-
-                if use_cache == "true" or use_cache == True:
-                    cached_info = load_from_cache(url)
-                    if cached_info:
-                        log_message("✅ Using cached info. Skipping retrieval.", True)
-                        info = cached_info
+            with PacedYoutubeDL(ydl_opts) as ydl:
+                job.set_stage("retrieve")
+                playlist_id = None
+                with job.span("retrieve", index):
+                    if job.sync and is_playlist(url):
+                        info = retrieve_new_entries(ydl, ydl_opts, url, job, target_folder)
+                        playlist_id = info and info["id"]
+                        task.playlist_id = playlist_id
                     else:
-                        log_message("♻️ No cache found. Retrieving info...", True)
-                        heartbeat_thread = threading.Thread(
-                            target=send_heartbeat, daemon=True
-                        )
-                        heartbeat_thread.start()
+                        info = retrieve_info(ydl, url, job)
+                job.set_stage("plan")
+                plan_start = time.time()
 
-                        info = ydl.extract_info(url, download=False)
-                        retrieving = False
-                        heartbeat_thread.join()
-                        save_to_cache(url, info)
-                else:
-                    heartbeat_thread = threading.Thread(
-                        target=send_heartbeat, daemon=True
+                retrieving = False
+                planner = PlaylistPlanner(ydl, job, existing_files, done_ids)
+                plan = planner.plan(info)
+                queued = [entry for entry in plan if entry.status == "queued"]
+                counts = collections.Counter(entry.status for entry in plan)
+
+                store.add_entries(job.id, index, [entry for entry in plan if entry.id])
+                job.add_span("plan", plan_start, index)
+                if playlist_id:
+                    store.add_to_manifest(
+                        playlist_id,
+                        target_folder,
+                        job.format_type,
+                        [
+                            (
+                                entry.id,
+                                "unavailable"
+                                if entry.title in UNAVAILABLE_TITLES
+                                else entry.status,
+                            )
+                            for entry in plan
+                            if entry.id and entry.status != "queued"
+                        ],
                     )
-                    heartbeat_thread.start()
-
-                    info = ydl.extract_info(url, download=False)
-                    retrieving = False
-                    heartbeat_thread.join()
-                    log_message("♻️ Caching retrieved information...", True)
-                    save_to_cache(url, info)
-
-                available_videos = []
-                expected_files = []
-
-                videos_to_download = []
-                videos_existing = []
-
-                # Check for available and unavailable videos before starting the download
-                if info and "entries" in info:  # Playlist
-                    for entry in info["entries"]:
-                        if entry:
-                            if entry.get("availability", "") == "unavailable":
-                                unavailable_videos.append(
-                                    entry.get("title", "Unknown Video")
-                                )
-                            else:
-                                filename = ydl.prepare_filename(entry)
-                                final_filename = (
-                                    os.path.splitext(filename)[0].strip()
-                                    + "."
-                                    + (format_type if format_type == "mp3" else "mp4")
-                                )
-                                if (
-                                    clean_filename(os.path.basename(final_filename))
-                                    not in existing_files
-                                ):
-                                    videos_to_download.append(entry["original_url"])
-                                    expected_files.append(final_filename)
-                                    available_videos.append(
-                                        entry.get("title", "Unknown Video")
-                                    )
-                                else:
-                                    videos_existing.append(final_filename)
-                        else:
-                            unavailable_videos.append("Unknown Video")
-                    to_download = len(videos_to_download)
-                    if format_type == "mp4":
-                        to_download = to_download * 2
-
-                else:  # Single Video
-                    if not info or info.get("availability", "") == "unavailable":
-                        unavailable_videos.append(
-                            info.get("title", "Unknown Video")
-                            if info
-                            else "Unknown Video"
-                        )
-                    else:
-                        filename = ydl.prepare_filename(info)
-                        final_filename = (
-                            os.path.splitext(filename)[0].strip()
-                            + "."
-                            + (format_type if format_type == "mp3" else "mp4")
-                        )
-                        if (
-                            clean_filename(os.path.basename(final_filename))
-                            not in existing_files
-                        ):
-                            videos_to_download.append(info["original_url"])
-                            expected_files.append(final_filename)
-                            available_videos.append(info.get("title", "Unknown Video"))
-                        else:
-                            videos_existing.append(final_filename)
-                        to_download = len(videos_to_download)
-                        if format_type == "mp4":
-                            to_download = to_download * 2
-
-                if not videos_to_download:
-                    log_message("✅ All videos are already downloaded.", True, True)
-                    time.sleep(0.2)
+                with job.lock:
+                    job.unavailable_videos.extend(
+                        entry.title for entry in plan if entry.status == "failed"
+                    )
+                    job.to_download += len(queued) * (2 if format_type == "mp4" else 1)
+
+                if not queued:
+                    job.log("✅ All videos are already downloaded.", True, True)
                     return {
                         "success": True,
                         "message": "All videos are already downloaded.",
                     }
 
-                info_msg = ""
-                if available_videos:
-                    info_msg += (
-                        "✅ The following videos are available for download:<br> - "
-                        + "<br> - ".join(available_videos)
-                        + f"<br> Total: {len(available_videos)}"
-                    )
-                if videos_existing:
-                    info_msg += f"<br><br>🆗 There are <strong>{len(videos_existing)}</strong> Videos that are already downloaded."
-                if unavailable_videos:
-                    info_msg += f"<br><br>❌ There are <strong>{len(unavailable_videos)}</strong> Videos that can not be downloaded.<br>"
-
-                time.sleep(0.2)
-                log_message(info_msg, True, True)
-                time.sleep(0.2)
-                retrieving = False
-                log_message("⏬ Starting Download ⏬", True)
-                time.sleep(0.2)
-
-                ydl.download(videos_to_download)
-                is_converting = False
-
-                album_name = os.path.basename(target_folder)
-                log_message(f"⚒ Managing Metadata<br>{20*'-'}<br>", True)
-                for final_filename in expected_files:
-                    cleaned_filename = clean_filename(os.path.basename(final_filename))
-                    if os.path.exists(final_filename):
-                        destination = os.path.join(target_folder, cleaned_filename)
-                        shutil.move(final_filename, destination)
-                        moved_files.append(cleaned_filename)
-
-                        update_metadata(username, destination, album_name)
-                    else:
-                        missing_files.append(cleaned_filename)
-
-                image_extensions = [".jpg", ".png", ".webp"]
-
-                # Check for any remaining images in the folder
-                remaining_files = os.listdir(output_path)
-                image_files = [
-                    f
-                    for f in remaining_files
-                    if any(f.lower().endswith(ext) for ext in image_extensions)
-                ]
-
-                for image_file in image_files:
-                    poster_path = os.path.join(
-                        target_folder, "poster" + os.path.splitext(image_file)[1]
+                # Only the first titles are sent, big playlists are paged by /jobs/<id>/plan
+                titles = [entry.title for entry in queued[:PLAN_PREVIEW]]
+                info_msg = (
+                    "✅ The following videos are available for download:<br> - "
+                    + "<br> - ".join(titles)
+                )
+                if len(queued) > len(titles):
+                    info_msg += f"<br> ... and {len(queued) - len(titles)} more"
+                info_msg += f"<br> Total: {len(queued)}"
+                if counts["done"]:
+                    info_msg += f"<br><br>🆗 There are <strong>{counts['done']}</strong> Videos that are already downloaded."
+                if counts["failed"]:
+                    info_msg += f"<br><br>❌ There are <strong>{counts['failed']}</strong> Videos that can not be downloaded.<br>"
+                if len(plan) > PLAN_PREVIEW:
+                    plan_url = f"/jobs/{job.id}/plan?index={index}"
+                    info_msg += f'<br><br>📋 Full plan: <a href="{plan_url}" target="_blank">{plan_url}</a>'
+
+                job.log(info_msg, True, True)
+
+                # Small downloads are done on the RAM disk, if there is one
+                size = sum(estimate_size(entry.info, format_type) for entry in queued)
+                if engine.reserve_scratch(size):
+                    task.reserved = size
+                    output_path = os.path.join(engine.workspace(job, tmpfs=True), str(index))
+                    os.makedirs(output_path, exist_ok=True)
+                    shutil.rmtree(task.output_path, ignore_errors=True)
+                    task.output_path = output_path
+                    outtmpl = ydl.params["outtmpl"]
+                    outtmpl["default"] = os.path.join(
+                        output_path, os.path.basename(outtmpl["default"])
                     )
-                    shutil.move(os.path.join(output_path, image_file), poster_path)
+                    for entry in queued:
+                        entry.filename = os.path.join(
+                            output_path, os.path.basename(entry.filename)
+                        )
+                    job.log(f"💾 Using RAM disk for {size / 1024**2:.0f} MB")
 
-                set_owner_recursive(target_folder, "carn1v0re", "bunk3rGroup")
-                clear_output_folder(output_path)
+                job.log("⏬ Starting Download ⏬", True)
 
-                current_download = None
-                last_percentage = None
-                to_download = 0
-                done_download = 1
-                time.sleep(3)
+                # Downloaded entries are converted and moved by the pipeline
+                # stages while this worker already downloads the next one.
+                task.queued = collections.deque(queued)
+                return download_entries(task, ydl)
 
-            return {"success": True, "message": complete_msg}
+        except yt_dlp.utils.DownloadCancelled:
+            job.log("🚫 Download canceled (by User).", True, True)
+            return {"error": "Download canceled (by User)"}
 
         except Exception as e:
-            current_download = None
-            last_percentage = None
-            to_download = 0
-            done_download = 1
             if any(
                 substring in str(e) for substring in ["Video unavailable", "private"]
             ):
                 if retrieving:
                     return
-                log_message(f"⚠️ INFO ⚠️ Error:<br>{str(e)}", True, True)
+                job.log(f"⚠️ INFO ⚠️ Error:<br>{str(e)}", True, True)
 
             else:
                 cookie_error = ""
                 if "format cookies file" in str(e):
                     cookie_error = "<br>🍪 Cookies are missing or invalid. Please check your data/cookies.txt file."
-                log_message(f"⚠️ INFO ⚠️ Error:<br>{str(e)}{cookie_error}", True, True)
+                job.log(f"⚠️ INFO ⚠️ Error:<br>{str(e)}{cookie_error}", True, True)
                 return {"error": str(e)}
 
 
+# --- Pipeline ---
+class PipelineEntry:
+    """A downloaded entry on its way to the target folder."""
+
+    def __init__(self, task, entry, filename, info):
+        self.task = task
+        self.entry = entry
+        self.filename = filename
+        self.info = info
+
+
+class AlbumMetadataPP(yt_dlp.postprocessor.FFmpegMetadataPP):
+    """
+    FFmpegMetadata that also sets album and album artist to the target folder,
+    so all tags are written in one pass before the file is moved.
+    """
+
+    def __init__(self, downloader, album, task):
+        super().__init__(downloader)
+        self.album = album
+        self.task = task
+
+    def run(self, info):
+        info["meta_album"] = info["meta_album_artist"] = self.album
+        start = time.monotonic()
+        with self.task.job.span("tag", self.task.index, info.get("id")):
+            result = super().run(info)
+        finalize_seconds.observe(time.monotonic() - start, step="tag")
+        return result
+
+
+def transcode_options(format_type):
+    """
+    Returns the yt-dlp options that only run the postprocessors of a format.
+    The metadata is added by AlbumMetadataPP, which needs the target folder.
+    """
+    postprocessors = [
+        {
+            "key": "EmbedThumbnail",
+        },
+    ]
+    codec = OUTPUT_FORMATS[format_type]["codec"]
+    if codec:
+        # Copies the audio stream if the download already has this codec
+        postprocessors.insert(
+            0,
+            {
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": codec,
+                "preferredquality": "320" if codec == "mp3" else None,
+            },
+        )
+    return {"postprocessors": postprocessors, "addmetadata": True}
+
+
+def transcode_entry(item):
+    """
+    Converts a downloaded entry and passes it on to the finalize stage.
+    The conversion itself runs in ffmpeg processes, so the threads of this
+    stage only wait for them.
+    """
+    job = item.task.job
+    if job.cancelled:
+        item.task.release()
+        return
+    downloads = (item.info or {}).get("requested_downloads") or []
+    try:
+        if downloads:
+            job.set_stage("convert")
+            job.log(f"⚒ Converting: {item.entry.get('title', 'Unknown Video')}")
+            # The same info yt-dlp itself hands to the postprocessors. The private
+            # keys belong to the download, e.g. the merger already ran for mp4.
+            info = {
+                key: value
+                for key, value in {**item.info, **downloads[0]}.items()
+                if not key.startswith("__")
+            }
+            album = album_title(job.username, item.task.target_folder)
+            with yt_dlp.YoutubeDL(transcode_options(job.format_type)) as ydl:
+                ydl.add_post_processor(AlbumMetadataPP(ydl, album, item.task))
+                start = time.monotonic()
+                with job.span("transcode", item.task.index, item.entry.get("id")):
+                    ydl.post_process(info["filepath"], info)
+                transcode_seconds.observe(time.monotonic() - start)
+    except Exception as e:
+        job.log(f"⚠️ INFO ⚠️ Error while converting:<br>{str(e)}", True, True)
+    finally:
+        job.set_stage(None)
+    finalize_stage.put(item)
+
+
+def finalize_entry(item):
+    """
+    Moves a converted entry to its target folder and records it. Every entry is
+    recorded on its own, so a restart only has to process the ones not done yet.
+    """
+    task, entry = item.task, item.entry
+    job = task.job
+    try:
+        job.set_stage("finalize")
+        cleaned_filename = clean_filename(os.path.basename(item.filename))
+        if os.path.exists(item.filename):
+            destination = os.path.join(task.target_folder, cleaned_filename)
+            start = time.monotonic()
+            before = library.folder_mtime(task.target_folder)
+            with job.span("move", task.index, entry["id"]):
+                move_file(item.filename, destination)
+            finalize_seconds.observe(time.monotonic() - start, step="move")
+            task.created.append(destination)
+            job.moved_files.append(cleaned_filename)
+
+            with job.span("record", task.index, entry["id"]):
+                library.add(destination, entry["id"], before)
+                store.set_entry_status(job.id, task.index, entry["id"], "done")
+                if task.playlist_id:
+                    store.add_to_manifest(
+                        task.playlist_id,
+                        task.target_folder,
+                        job.format_type,
+                        [(entry["id"], "done")],
+                    )
+        else:
+            job.missing_files.append(cleaned_filename)
+            store.set_entry_status(
+                job.id, task.index, entry["id"], "failed", "File missing after download"
+            )
+    finally:
+        job.set_stage(None)
+        task.release()
+
+
+transcode_stage = Stage(
+    "transcode", TRANSCODE_WORKERS, PIPELINE_QUEUE_SIZE, transcode_entry
+)
+finalize_stage = Stage("finalize", 1, PIPELINE_QUEUE_SIZE, finalize_entry)
+
+
 if __name__ == "__main__":
-    clear_output_folder(OUTPUT_DIR)
+    # Keep the partial downloads of unfinished jobs, they are resumed below
+    resumable = {row["id"] for row, _ in store.unfinished_jobs()}
+    for staging in {OUTPUT_DIR, SCRATCH_TMPFS, *staging_paths.values()} - {None}:
+        if os.path.isdir(staging):
+            clear_stale_output(staging, resumable)
+    resumed = engine.resume()
+    if resumed:
+        print(f"♻️ Resumed {len(resumed)} unfinished jobs")
     print("🚀 Starting Server...")
     if IP == "0.0.0.0":
         print(f"🔗 Access the server at http://localhost:{PORT}")
@@ -0,0 +1,55 @@
+"""
+Stand-in for ffmpeg and ffprobe in the benchmarks, called as
+`fake_ffmpeg.py ffmpeg|ffprobe args...` by the wrappers that run.py puts on
+the PATH. Conversions copy the first input to the output and take
+BENCH_FFMPEG_SECONDS_PER_MB seconds per MB, so the pipeline can be measured
+without encoding real media.
+"""
+import json
+import os
+import shutil
+import sys
+import time
+
+VERSION = "ffmpeg version 6.0-bench Copyright (c) 2000-2023 the FFmpeg developers"
+
+# Codecs reported by ffprobe for the extensions of the downloaded files
+CODECS = {".webm": "opus", ".opus": "opus", ".m4a": "aac", ".mp4": "aac", ".mp3": "mp3"}
+
+
+def strip_protocol(path):
+    return path[len("file:"):] if path.startswith("file:") else path
+
+
+def ffprobe(args):
+    if "-version" in args or "-bsfs" in args:
+        print(VERSION.replace("ffmpeg", "ffprobe", 1))
+        return 0
+    path = strip_protocol(args[-1])
+    codec = CODECS.get(os.path.splitext(path)[1], "aac")
+    if "json" in args:
+        stream = {"index": 0, "codec_name": codec, "codec_type": "audio", "disposition": {}}
+        print(json.dumps({"streams": [stream], "format": {"filename": path, "tags": {}}}))
+    else:
+        print(f"[STREAM]\ncodec_name={codec}\ncodec_type=audio\n[/STREAM]")
+    return 0
+
+
+def ffmpeg(args):
+    # yt-dlp reads the version from the output of `ffmpeg -bsfs`
+    if "-version" in args or "-bsfs" in args:
+        print(VERSION)
+        return 0
+    inputs = [strip_protocol(args[i + 1]) for i, arg in enumerate(args[:-1]) if arg == "-i"]
+    if not inputs or len(args) < 2:
+        return 0
+    output = strip_protocol(args[-1])
+    shutil.copyfile(inputs[0], output)
+    seconds_per_mb = float(os.environ.get("BENCH_FFMPEG_SECONDS_PER_MB", "0"))
+    time.sleep(os.path.getsize(inputs[0]) / 1024**2 * seconds_per_mb)
+    return 0
+
+
+if __name__ == "__main__":
+    tool, args = sys.argv[1], sys.argv[2:]
+    sys.exit(ffprobe(args) if tool == "ffprobe" else ffmpeg(args))
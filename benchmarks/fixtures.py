@@ -0,0 +1,134 @@
+"""
+Offline stand-ins for YouTube: a stub extractor that replays the infos in
+example-retrieved-infos as synthetic playlists, and a local HTTP server that
+serves dummy media for their formats.
+"""
+import copy
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EXAMPLES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example-retrieved-infos"
+)
+EXAMPLE_FILES = ("playlist-example-info.json", "single-video-example-info.json")
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves `size` bytes for /media/<name>?size=<size>, with Range support."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        size = int(urllib.parse.parse_qs(url.query).get("size", ["1024"])[0])
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        chunk = b"\0" * 65536
+        remaining = end - start + 1
+        while remaining > 0:
+            self.wfile.write(chunk[: min(remaining, len(chunk))])
+            remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer:
+    """The HTTP server on a free local port, running in a daemon thread."""
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+class StubExtractor:
+    """
+    Replays the example infos as playlists of `size` entries. Every entry gets
+    an unique ID, and its formats and thumbnails point to the media server.
+    `media_bytes` is the size of an audio stream, video streams are 4 times larger.
+    """
+
+    def __init__(self, server_url, media_bytes=256 * 1024):
+        self.server_url = server_url
+        self.media_bytes = media_bytes
+        self.examples = []
+        for name in EXAMPLE_FILES:
+            with open(os.path.join(EXAMPLES_DIR, name), "r", encoding="utf-8") as f:
+                self.examples.append(json.load(f))
+
+    def entry(self, index, video_id, title):
+        info = copy.deepcopy(self.examples[index % len(self.examples)])
+        for key in ("requested_formats", "requested_downloads", "url", "format_id"):
+            info.pop(key, None)
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        info.update(
+            id=video_id,
+            title=title,
+            fulltitle=title,
+            display_id=video_id,
+            webpage_url=url,
+            original_url=url,
+            epoch=int(time.time()),
+        )
+        formats = []
+        for f in info["formats"]:
+            if f.get("protocol") != "https":
+                continue  # storyboards
+            size = self.media_bytes * (1 if f.get("vcodec") == "none" else 4)
+            f = dict(f, filesize=size, filesize_approx=size)
+            f["url"] = f"{self.server_url}/media/{video_id}-{f['format_id']}?size={size}"
+            f.pop("fragments", None)
+            formats.append(f)
+        info["formats"] = formats
+        thumbnail = f"{self.server_url}/media/{video_id}.webp?size=2048"
+        info["thumbnails"] = [{"url": thumbnail, "id": "0", "preference": 0}]
+        info["thumbnail"] = thumbnail
+        return info
+
+    def playlist(self, playlist_id, size):
+        """A playlist info with `size` entries, like yt-dlp returns it."""
+        entries = [
+            self.entry(i, f"{playlist_id[-5:]}{i:06d}", f"Bench Video {playlist_id} #{i}")
+            for i in range(size)
+        ]
+        return {
+            "_type": "playlist",
+            "id": playlist_id,
+            "title": f"Bench Playlist {playlist_id}",
+            "webpage_url": f"https://www.youtube.com/playlist?list={playlist_id}",
+            "extractor": "youtube:tab",
+            "extractor_key": "YoutubeTab",
+            "entries": entries,
+        }
+
+    def retrieve_info(self, sizes):
+        """
+        Returns a replacement for app.retrieve_info. `sizes` maps the playlist
+        IDs to their number of entries.
+        """
+
+        def retrieve_info(ydl, url, job):
+            playlist_id = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)["list"][0]
+            return self.playlist(playlist_id, sizes[playlist_id])
+
+        return retrieve_info
@@ -0,0 +1,224 @@
+"""
+Offline benchmarks of the download engine. Runs without network: the infos
+in example-retrieved-infos are replayed by a stub extractor, the media is
+served by a local HTTP server and ffmpeg is replaced by fake_ffmpeg.py.
+
+    python benchmarks/run.py [--entries 200] [--workers 1,2,4] [--json out.json]
+    python benchmarks/run.py --baseline out.json   # compare with an earlier run
+
+Everything is written to a temporary folder, the repository stays untouched.
+"""
+import argparse
+import functools
+import json
+import os
+import stat
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def install_fake_ffmpeg(folder):
+    """Puts ffmpeg/ffprobe wrappers for fake_ffmpeg.py first on the PATH."""
+    bin_dir = os.path.join(folder, "bin")
+    os.makedirs(bin_dir)
+    for tool in ("ffmpeg", "ffprobe"):
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(
+                f'#!/bin/sh\nexec "{sys.executable}" '
+                f'"{os.path.join(BENCH_DIR, "fake_ffmpeg.py")}" {tool} "$@"\n'
+            )
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+
+def load_app(folder, rate):
+    """Imports app.py with its working directory in `folder`, without console output."""
+    os.chdir(folder)
+    os.makedirs("data")
+    with open(os.path.join("data", "folders.json"), "w") as f:
+        json.dump({"folders": {"bench": os.path.join(folder, "library")}}, f)
+    sys.path.insert(0, REPO_DIR)
+    import app
+    import yt_dlp
+
+    app.log_listener.handlers = (app.file_handler,)
+    app.YtdlpLogger.debug = app.YtdlpLogger.info = lambda self, msg: None
+    # The files belong to the user running the benchmark
+    app.set_owner = functools.partial(app.set_owner, user=None, group=None)
+    # The media server does not need pacing, unless the limiter itself is measured
+    rate = rate or float("inf")
+    app.rate_limiter = app.RateLimiter(rate, max_rate=rate, burst=max(1, min(rate, 5)))
+
+    class YoutubeDL(yt_dlp.YoutubeDL):
+        def __init__(self, params=None, *args, **kwargs):
+            super().__init__(dict(params or {}, quiet=True), *args, **kwargs)
+
+    # Conversions only, downloads use app.PacedYoutubeDL
+    yt_dlp.YoutubeDL = YoutubeDL
+    return app
+
+
+def measure(func, *args, memory=False):
+    """Runs func and returns its result, the seconds it took and the peak of traced memory."""
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+class Runner:
+    def __init__(self, app, stub, format_type):
+        self.app = app
+        self.stub = stub
+        self.format_type = format_type
+        self.runs = 0
+
+    def run_job(self, playlists, entries, workers):
+        """Runs a job with `playlists` URLs of `entries` entries each and waits for it."""
+        app = self.app
+        self.runs += 1
+        # New IDs for every run, otherwise the library skips the videos
+        sizes = {f"PLbench{self.runs:03d}{i:02d}": entries for i in range(playlists)}
+        app.retrieve_info = self.stub.retrieve_info(sizes)
+        app.engine = app.DownloadEngine(workers)
+        urls = [f"https://www.youtube.com/playlist?list={pl}" for pl in sizes]
+        job = app.DownloadJob(
+            "bench", urls, "bench", "", self.format_type, f"run{self.runs}", "false"
+        )
+        app.engine.submit(job)
+        while not job.finished:
+            time.sleep(0.01)
+        return job
+
+    def clean_filename(self, calls):
+        titles = [f"Bench Video: «{i}» / feat. Ünïcödé *remix* (Official Video)" for i in range(calls)]
+        _, seconds, _ = measure(lambda: [self.app.clean_filename(t) for t in titles])
+        return {"clean_filename_us": seconds / calls * 1e6}
+
+    def cache(self, entries):
+        app = self.app
+        info = self.stub.playlist("PLbenchcache", entries)
+        url = "https://www.youtube.com/playlist?list=PLbenchcache"
+        _, save, save_peak = measure(app.metadata_cache.save, url, info, memory=True)
+        path = os.path.join(app.metadata_cache.folder, app.metadata_cache.filename(url))
+        _, load, load_peak = measure(app.metadata_cache.load, url, memory=True)
+        return {
+            "cache_save_s": save,
+            "cache_load_s": load,
+            "cache_file_kb": os.path.getsize(path) / 1024,
+            "cache_save_peak_mb": save_peak / 1024**2,
+            "cache_load_peak_mb": load_peak / 1024**2,
+        }
+
+    def progress_hook(self, calls):
+        app = self.app
+        job = app.DownloadJob("bench", [], "bench", "", self.format_type, "hook", "false")
+        d = {
+            "status": "downloading",
+            "downloaded_bytes": 1024,
+            "total_bytes": 4096,
+            "speed": 1e6,
+            "eta": 3,
+            "info_dict": {"id": "hookbench01", "title": "Hook"},
+        }
+        hook = functools.partial(app.my_hook, job=job)
+        _, seconds, _ = measure(lambda: [hook(d) for _ in range(calls)])
+        return {"progress_hook_us": seconds / calls * 1e6}
+
+    def planning(self, entries):
+        """Time of the planning loop (the "plan" span) with the downloads stubbed out."""
+        app = self.app
+        download_entry = app.download_entry
+        app.download_entry = lambda ydl, entry, job: None
+        try:
+            job = self.run_job(1, entries, 1)
+            plan = sum(s["end"] - s["start"] for s in job.timeline() if s["name"] == "plan")
+            _, _, peak = measure(self.run_job, 1, entries, 1, memory=True)
+        finally:
+            app.download_entry = download_entry
+        return {"plan_s": plan, "plan_entry_us": plan / entries * 1e6, "job_peak_mb": peak / 1024**2}
+
+    def end_to_end(self, playlists, entries, workers):
+        job, seconds, _ = measure(self.run_job, playlists, entries, workers)
+        done = len(job.moved_files)
+        return {
+            f"e2e_w{workers}_s": seconds,
+            f"e2e_w{workers}_entries_per_s": done / seconds,
+            f"e2e_w{workers}_mb_per_s": done * self.stub.media_bytes / 1024**2 / seconds,
+            f"e2e_w{workers}_failed": len(job.missing_files),
+        }
+
+
+def compare(results, baseline):
+    print(f"\n{'metric':32} {'baseline':>12} {'now':>12} {'change':>8}")
+    for key, value in results.items():
+        old = baseline.get(key)
+        change = f"{(value - old) / old * 100:+.1f}%" if old else ""
+        old = "-" if old is None else f"{old:.6g}"
+        print(f"{key:32} {old:>12} {value:>12.6g} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the download engine.")
+    parser.add_argument("--entries", type=int, default=200, help="entries of the planned playlists")
+    parser.add_argument("--e2e-entries", type=int, default=20, help="entries per downloaded playlist")
+    parser.add_argument("--playlists", type=int, default=4, help="playlists per end-to-end job")
+    parser.add_argument("--workers", default="1,2,4", help="worker counts for the end-to-end runs")
+    parser.add_argument("--media-kb", type=int, default=256, help="size of an audio stream")
+    parser.add_argument("--format", default="mp3", help="output format of the jobs")
+    parser.add_argument("--ffmpeg-seconds-per-mb", type=float, default=0.0, help="simulated encoding time")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second of the rate limiter, 0 = unpaced")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--baseline", help="compare with the results of an earlier run")
+    args = parser.parse_args()
+
+    os.environ["BENCH_FFMPEG_SECONDS_PER_MB"] = str(args.ffmpeg_seconds_per_mb)
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="ytdl-bench-")
+    install_fake_ffmpeg(workdir)
+    app = load_app(workdir, args.rate)
+    from fixtures import MediaServer, StubExtractor
+
+    server = MediaServer()
+    runner = Runner(app, StubExtractor(server.url, args.media_kb * 1024), args.format)
+
+    results = {}
+    steps = [
+        ("clean_filename", lambda: runner.clean_filename(10000)),
+        ("cache", lambda: runner.cache(args.entries)),
+        ("progress hook", lambda: runner.progress_hook(100000)),
+        ("planning", lambda: runner.planning(args.entries)),
+    ] + [
+        (f"end-to-end, {w} workers", functools.partial(runner.end_to_end, args.playlists, args.e2e_entries, w))
+        for w in map(int, args.workers.split(","))
+    ]
+    for name, step in steps:
+        print(f"⏱️ {name}...", flush=True)
+        for key, value in step().items():
+            results[key] = value
+            print(f"   {key:32} {value:.6g}")
+    server.close()
+
+    if args.json:
+        with open(os.path.join(cwd, args.json), "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(os.path.join(cwd, args.baseline)) as f:
+            compare(results, json.load(f))
+    print(f"📂 Working folder: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,141 @@
 import os
+import sys
+import time
+import argparse
 import subprocess
-import questionary
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Hardcoded root path to start from
 rootpath = '/Path/To/Your/Folder'  # Change this to your root directory path
-if rootpath == '/Path/To/Your/Folder':
-    print("\n⚠️ Please change the root path in the script to your desired rootpath! 🔧")
-    exit()
-
-def convert_to_mp3(file_path):
-    """ Converts .mp4 or .m4a files to .mp3 """
-    mp3_file = file_path.rsplit('.', 1)[0] + '.mp3'
-    subprocess.run(['ffmpeg', '-i', file_path, '-q:a', '2', '-map', 'a', mp3_file, '-loglevel', 'quiet'])
-    print(f'Converted {file_path} to {mp3_file}')
-
-def extract_first_frame(mp4_file):
-    """ Extracts the first frame of an MP4 file and saves it as a JPG """
-    jpg_file = mp4_file.replace('.mp4', '-poster.jpg')
-    subprocess.run(['ffmpeg', '-i', mp4_file, '-vframes', '1', '-q:v', '2', jpg_file, '-loglevel', 'quiet'])
-    print(f'Extracted first frame from {mp4_file} to {jpg_file}')
-
-def process_file(file_path):
-    """ Processes individual files: Convert to MP3, extract frames for MP4, and delete original """
-    if file_path.endswith(('.mp4', '.m4a')):
-        convert_to_mp3(file_path)
-        if file_path.endswith('.mp4'):
-            extract_first_frame(file_path)
-        os.remove(file_path)
-        print(f'Removed {file_path}')
-
-def process_directory(directory):
-    """ Processes all MP4 and M4A files in a directory recursively """
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            process_file(file_path)
+
+# Extensions that are converted to .mp3
+SOURCE_EXTENSIONS = ('.mp4', '.m4a')
+
+# Exit codes for the batch mode (cron only mails on a non zero code)
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+print_lock = threading.Lock()
+
+def log(message):
+    """ Prints a line without mixing up the output of parallel workers """
+    with print_lock:
+        print(message, flush=True)
+
+def mp3_path(file_path):
+    return file_path.rsplit('.', 1)[0] + '.mp3'
+
+def poster_path(file_path):
+    return file_path.rsplit('.', 1)[0] + '-poster.jpg'
+
+def has_video(file_path):
+    """ True if ffprobe finds a video stream (or cover) in the file, audio-only .mp4 files have none """
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=index',
+         '-of', 'csv=p=0', file_path],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    return result.returncode == 0 and bool(result.stdout.strip())
+
+def is_up_to_date(file_path):
+    """ True if the .mp3 of a file exists and is newer than the file itself """
+    target = mp3_path(file_path)
+    return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(file_path)
+
+def convert_file(file_path):
+    """
+    Converts .mp4 or .m4a files to .mp3, for .mp4 files with a video stream the
+    first frame is written as poster by the same ffmpeg run. The .mp3 is written to a temporary
+    file first, so an aborted run never leaves a file that looks up to date.
+    """
+    mp3_file = mp3_path(file_path)
+    part_file = mp3_file + '.part'
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-i', file_path,
+               '-map', 'a', '-q:a', '2', '-f', 'mp3', part_file]
+    if file_path.endswith('.mp4') and has_video(file_path):
+        command += ['-map', '0:v:0', '-frames:v', '1', '-q:v', '2', poster_path(file_path)]
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f'ffmpeg exited with {result.returncode}')
+        os.replace(part_file, mp3_file)
+    finally:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+    return mp3_file
+
+def process_file(file_path, keep=False):
+    """ Processes individual files: Convert to MP3 (and poster for MP4), and delete original """
+    if file_path.endswith(SOURCE_EXTENSIONS):
+        mp3_file = convert_file(file_path)
+        log(f'Converted {file_path} to {mp3_file}')
+        if not keep:
+            os.remove(file_path)
+            log(f'Removed {file_path}')
+
+def find_files(paths):
+    """ Collects all MP4 and M4A files of the given files and directories (recursively) """
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            if path.endswith(SOURCE_EXTENSIONS):
+                files.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            for name in sorted(names):
+                if name.endswith(SOURCE_EXTENSIONS) and not name.startswith('.'):
+                    files.append(os.path.join(root, name))
+    return files
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{size:.1f} {unit}'
+        size /= 1024
+
+def run_batch(paths, workers=None, keep=False):
+    """
+    Converts all files below the given paths on a pool of workers (one ffmpeg
+    process each) and prints a summary. Returns the exit code.
+    """
+    files = find_files(paths)
+    todo = [f for f in files if not is_up_to_date(f)]
+    skipped = len(files) - len(todo)
+    workers = workers or os.cpu_count() or 1
+    log(f'🔎 Found {len(files)} files, {skipped} already converted, {len(todo)} to convert with {workers} workers.')
+
+    start = time.time()
+    converted = 0
+    failed = []
+    converted_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_file, f, keep): (f, os.path.getsize(f)) for f in todo}
+        for done, future in enumerate(as_completed(futures), start=1):
+            file_path, size = futures[future]
+            try:
+                future.result()
+                converted += 1
+                converted_bytes += size
+            except Exception as e:
+                failed.append(file_path)
+                log(f'⚠️ Failed {file_path}: {e}')
+            log(f'[{done}/{len(todo)}] {file_path}')
+
+    elapsed = time.time() - start
+    rate = converted / elapsed if elapsed else 0
+    throughput = converted_bytes / elapsed if elapsed else 0
+    log(f'✅ Converted {converted}, skipped {skipped}, failed {len(failed)} in {elapsed:.1f}s '
+        f'({rate:.2f} files/s, {format_size(throughput)}/s)')
+    for file_path in failed:
+        log(f'❌ {file_path}')
+    return EXIT_FAILED if failed else EXIT_OK
 
 def select_folder_or_file(path):
     """ Interactive selection of folders or files """
+    import questionary
+
     items = [item for item in os.listdir(path) if not item.startswith('.')]
     choices = []
 
@@ -45,7 +143,7 @@ def select_folder_or_file(path):
         full_path = os.path.join(path, item)
         if os.path.isdir(full_path):
             choices.append(f"[Folder] {item}")
-        elif os.path.isfile(full_path) and item.endswith(('.mp4', '.m4a')):
+        elif os.path.isfile(full_path) and item.endswith(SOURCE_EXTENSIONS):
             choices.append(f"[File] {item}")
 
     if not choices:
@@ -68,12 +166,31 @@ def select_folder_or_file(path):
         if action == "Enter":
             select_folder_or_file(selected_path)
         elif action == "Select":
-            process_directory(selected_path)
+            run_batch([selected_path])
     elif os.path.isfile(selected_path):
         process_file(selected_path)
 
 def main():
+    parser = argparse.ArgumentParser(
+        description='Converts .mp4/.m4a files to .mp3. Without paths the folders are selected interactively.'
+    )
+    parser.add_argument('paths', nargs='*', help='files or folders to convert (recursively)')
+    parser.add_argument('-j', '--workers', type=int, help='number of parallel ffmpeg processes (default: number of cores)')
+    parser.add_argument('-k', '--keep', action='store_true', help='keep the original files')
+    args = parser.parse_args()
+
+    if args.paths:
+        missing = [path for path in args.paths if not os.path.exists(path)]
+        if missing:
+            print(f"⚠️ Paths not found: {', '.join(missing)}")
+            return EXIT_USAGE
+        return run_batch(args.paths, args.workers, args.keep)
+
+    if rootpath == '/Path/To/Your/Folder':
+        print("\n⚠️ Please change the root path in the script to your desired rootpath! 🔧")
+        return EXIT_USAGE
     select_folder_or_file(rootpath)
+    return EXIT_OK
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
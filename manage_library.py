@@ -0,0 +1,23 @@
+import sys
+import time
+from app import folder_paths, library
+
+def backfill(folders, reread=False):
+    """ Indexes all media files of the given output folders, `reread` reads the tags of known files again """
+    total = 0
+    for name, path in folders.items():
+        start = time.time()
+        count = library.scan(path, reread=reread)
+        total += count
+        print(f"📚 Indexed {count} files in '{name}' ({path}) in {time.time() - start:.1f}s")
+    print(f"🔧 Library index contains {total} files.")
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    reread = "--reread" in args
+    selected = [arg for arg in args if arg != "--reread"] or list(folder_paths)
+    unknown = [name for name in selected if name not in folder_paths]
+    if unknown:
+        print(f"⚠️ Unknown folders: {', '.join(unknown)}")
+        sys.exit(1)
+    backfill({name: folder_paths[name] for name in selected}, reread)
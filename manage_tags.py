@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import mutagen
+from app import folder_paths, LIBRARY_FORMATS, update_metadata
+
+# Files that are tagged at the same time, mostly waiting for the (network) storage
+RETAG_WORKERS = 8
+
+def media_files(path):
+    """ Lists the media files below a folder with the folder they are in """
+    for root, _, files in os.walk(path):
+        for name in files:
+            if os.path.splitext(name)[1][1:].lower() in LIBRARY_FORMATS:
+                yield root, os.path.join(root, name)
+
+def album_user(file_path):
+    """ The user in the album tag of a file ("User - Folder"), None if it has none """
+    try:
+        audio = mutagen.File(file_path, easy=True)
+    except Exception:
+        return None
+    album = (audio.get("album") or [""])[0] if audio else ""
+    user, separator, _ = album.partition(" - ")
+    return user if separator and user else None
+
+def retag(folders, user=None):
+    """
+    Sets album and album artist of all files to their folder name, like new downloads.
+    The user in the album keeps the one already in the file, `user` is used for files
+    without one. Files without a user are skipped, only files with different tags are written.
+    """
+    def tag(folder, file_path):
+        owner = album_user(file_path) or user
+        return update_metadata(owner, file_path, folder) if owner else None
+
+    total = changed = skipped = 0
+    for name, path in folders.items():
+        start = time.time()
+        files = list(media_files(path))
+        with ThreadPoolExecutor(max_workers=RETAG_WORKERS) as pool:
+            results = list(pool.map(lambda f: tag(*f), files))
+        total += len(files)
+        changed += sum(1 for result in results if result)
+        skipped += results.count(None)
+        print(f"🏷️ Re-tagged {sum(1 for result in results if result)} of {len(files)} files in '{name}' ({path}) in {time.time() - start:.1f}s")
+    print(f"🔧 {changed} of {total} files changed.")
+    if skipped:
+        print(f"⚠️ {skipped} files skipped without a user in their album, set one with --user NAME.")
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    user = None
+    if "--user" in args:
+        at = args.index("--user")
+        if at + 1 >= len(args):
+            print("⚠️ --user needs a name")
+            sys.exit(1)
+        user = args[at + 1]
+        del args[at:at + 2]
+    selected = args or list(folder_paths)
+    unknown = [name for name in selected if name not in folder_paths]
+    if unknown:
+        print(f"⚠️ Unknown folders: {', '.join(unknown)}")
+        sys.exit(1)
+    retag({name: folder_paths[name] for name in selected}, user)